@@ -0,0 +1,216 @@
+"""
+A local stand-in for the OpenAI API, for benchmarking without paying for or
+waiting on the real one.
+
+Serves /v1/chat/completions (plain, streamed and function calls) and
+/v1/embeddings (1536-dim unit vectors) with configurable latency. Payloads
+are derived from a hash of the request, so the same request always gets the
+same response. Request counts per endpoint are served at /stats.
+
+    python benchmarks/fake_openai.py --port 8089 --chat-latency 400 --embedding-latency 50
+
+then point the bot at it with OPENAI_API_BASE=http://127.0.0.1:8089/v1.
+"""
+import re
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+import threading
+
+import numpy as np
+from aiohttp import web
+
+EMBEDDING_DIMENSIONS = 1536
+WORDS = "sure here is what i know about that topic and a few more details you might find useful".split()
+
+
+def digest(text):
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+def fake_embedding(text):
+    rng = np.random.default_rng(int.from_bytes(digest(text)[:8], "little"))
+    vector = rng.standard_normal(EMBEDDING_DIMENSIONS).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def fake_reply(messages, words):
+    seed = digest(json.dumps(messages, sort_keys=True))
+    return " ".join(WORDS[(seed[i % len(seed)] + i) % len(WORDS)] for i in range(words))
+
+
+def fake_function_arguments(name, messages):
+    last = messages[-1]["content"] if messages else ""
+    if name == "store_insights":
+        num_interactions = len(re.findall(r"^\d+\. user:", last, re.MULTILINE))
+        return {
+            "insights": [
+                {"content": "The user is benchmarking the bot.", "importance": 6},
+                {"content": "The user asks many questions.", "importance": 4},
+            ],
+            "interaction_importance": [5] * num_interactions,
+        }
+    if name == "pin_message":
+        user_messages = [m["content"] for m in messages if m["role"] == "user"]
+        message = user_messages[-1] if user_messages else ""
+        return {"message": message if "remember" in message.lower() else None}
+    return {}
+
+
+def fake_content(messages, words):
+    last = messages[-1]["content"] if messages else ""
+    if "rate the importance" in last:
+        return "5"
+    if "high-level insights" in last:
+        return '["The user is benchmarking the bot.", "The user asks many questions."]'
+    if "rewrite the summary" in last:
+        return "The user has been asking the bot a series of benchmark questions."
+    return fake_reply(messages, words)
+
+
+class FakeOpenAI:
+    """
+    The fake API's state: latencies in seconds and request counts.
+    """
+    def __init__(self, chat_latency=0.4, embedding_latency=0.05, stream_delay=0.01, response_words=60):
+        self.chat_latency = chat_latency
+        self.embedding_latency = embedding_latency
+        self.stream_delay = stream_delay
+        self.response_words = response_words
+        self.counts = {"chat": 0, "function_call": 0, "stream": 0, "embedding": 0, "embedding_inputs": 0}
+        self.lock = threading.Lock()
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+    def reset(self):
+        with self.lock:
+            for key in self.counts:
+                self.counts[key] = 0
+
+    async def chat_completions(self, request):
+        body = await request.json()
+        messages = body.get("messages", [])
+        model = body.get("model", "gpt-3.5-turbo")
+        await asyncio.sleep(self.chat_latency)
+        message = {"role": "assistant", "content": None}
+        if body.get("functions"):
+            self.count("function_call")
+            function_call = body.get("function_call")
+            if isinstance(function_call, dict):
+                name = function_call["name"]
+            else:
+                name = body["functions"][0]["name"]
+            message["function_call"] = {
+                "name": name,
+                "arguments": json.dumps(fake_function_arguments(name, messages)),
+            }
+        else:
+            message["content"] = fake_content(messages, self.response_words)
+        if body.get("stream"):
+            self.count("stream")
+            return await self.stream(request, model, message["content"] or "")
+        self.count("chat")
+        return web.json_response(
+            {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            }
+        )
+
+    async def stream(self, request, model, content):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for word in re.findall(r"\S+\s*", content):
+            chunk = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            await asyncio.sleep(self.stream_delay)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def embeddings(self, request):
+        body = await request.json()
+        inputs = body["input"]
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        self.count("embedding")
+        self.count("embedding_inputs", len(inputs))
+        await asyncio.sleep(self.embedding_latency)
+        return web.json_response(
+            {
+                "object": "list",
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": fake_embedding(text)}
+                    for i, text in enumerate(inputs)
+                ],
+                "model": body.get("model", "text-embedding-ada-002"),
+                "usage": {"prompt_tokens": 0, "total_tokens": 0},
+            }
+        )
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats())
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/v1/embeddings", self.embeddings)
+        app.router.add_get("/stats", self.get_stats)
+        return app
+
+
+def start_in_thread(fake, host="127.0.0.1", port=0):
+    """
+    Serves `fake` from a background thread. Returns the API base URL.
+    """
+    started = threading.Event()
+    address = {}
+
+    async def serve():
+        runner = web.AppRunner(fake.app())
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        address["port"] = site._server.sockets[0].getsockname()[1]
+        started.set()
+        await asyncio.Event().wait()
+
+    threading.Thread(target=lambda: asyncio.run(serve()), name="fake-openai", daemon=True).start()
+    started.wait()
+    return f"http://{host}:{address['port']}/v1"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--chat-latency", type=float, default=400, help="milliseconds")
+    parser.add_argument("--embedding-latency", type=float, default=50, help="milliseconds")
+    parser.add_argument("--stream-delay", type=float, default=10, help="milliseconds between streamed words")
+    parser.add_argument("--response-words", type=int, default=60)
+    args = parser.parse_args()
+    fake = FakeOpenAI(
+        chat_latency=args.chat_latency / 1000,
+        embedding_latency=args.embedding_latency / 1000,
+        stream_delay=args.stream_delay / 1000,
+        response_words=args.response_words,
+    )
+    web.run_app(fake.app(), host=args.host, port=args.port)
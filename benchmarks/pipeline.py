@@ -0,0 +1,224 @@
+"""
+End-to-end benchmark of the chat pipeline (`ChatGPT.asend_message`, memorize,
+reflection and `Memory.search`) against the fake OpenAI server in
+benchmarks/fake_openai.py.
+
+Long-term memory goes to Postgres if DB_URI is set (rows are added to a
+"benchmark" bot, in a new partition per run), otherwise to the in-process
+local backend in a temporary directory. Postgres runs default to the shared
+storage mode, so no database has to be created for the benchmark bot; set
+DB_STORAGE_MODE=per_bot (with a "benchmark" database) to measure that instead.
+
+For every combination of short-term history size and memory table size it
+reports turn latency percentiles, throughput, and the number of chat and
+embedding requests per turn, including the background requests made after
+the reply.
+
+    python benchmarks/pipeline.py --turns 50 --concurrency 4 --history 0 20 100 --table 0 1000 10000
+"""
+import os
+import sys
+import time
+import json
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+os.environ.setdefault("DISCORD_BOT_TOKEN", "benchmark")
+os.environ.setdefault("DISCORD_USERS", "benchmark")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("SHORT_TERM_STORE", "none")
+os.environ.setdefault("LOCAL_MEMORY_PATH", tempfile.mkdtemp(prefix="benchmark-memory-"))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("DB_STORAGE_MODE", "shared")
+
+import numpy as np
+import openai
+
+from fake_openai import FakeOpenAI, start_in_thread
+from db import DB
+from gpt import ChatGPT
+from memory import flush_all
+from memory_backend import create_memory_backend
+from reflection import reflection_scheduler
+from openai_tools import close_async_client
+
+BOT_NAME = "benchmark"
+QUESTIONS = [
+    "What can you do?",
+    "Can you remember that my favourite colour is green?",
+    "Summarize what we talked about yesterday.",
+    "How do I reset my password?",
+    "Tell me a fact about octopuses.",
+    "What's a good name for a cat?",
+]
+
+
+class BenchmarkConfigs:
+    """
+    Holds the benchmark bot's config when there is no database to read it from.
+    """
+    disabled = True
+
+    def __init__(self):
+        self.bot_configs = {}
+        self.versions = {}
+
+    def get_config_version(self, name):
+        return self.versions.get(name, 0)
+
+    def set_config(self, name, config):
+        self.bot_configs[name] = config
+        self.versions[name] = self.versions.get(name, 0) + 1
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) * 1000 if values else 0.0
+
+
+def prefill_memory(backend, partition, size, batch_size=1000):
+    rng = np.random.default_rng(0)
+    for start in range(0, size, batch_size):
+        count = min(batch_size, size - start)
+        vectors = rng.standard_normal((count, 1536)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        backend.insert_memories(
+            BOT_NAME,
+            [
+                {
+                    "embedding": vector,
+                    "metadata": {
+                        "message": f"Earlier message {start + i}",
+                        "response": f"Earlier response {start + i}",
+                        "importance": float(rng.uniform(0.1, 1.0)),
+                        "timestamp": f"2023-0{1 + (start + i) % 9}-15T12:00:00",
+                    },
+                    "partition": partition,
+                }
+                for i, vector in enumerate(vectors)
+            ],
+        )
+
+
+def prefill_history(chatgpt, channel_id, size):
+    chatgpt.get_short_term_memory(channel_id).extend(
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"History message {i}: {QUESTIONS[i % len(QUESTIONS)]}"}
+        for i in range(size)
+    )
+
+
+def wait_for_background(timeout=60):
+    """
+    Waits for reflections to drain and flushes buffered memory writes.
+    """
+    deadline = time.monotonic() + timeout
+    while reflection_scheduler.stats()["pending"] and time.monotonic() < deadline:
+        time.sleep(0.05)
+    # let in-flight memorize threads and reflections finish
+    time.sleep(1.0)
+    flush_all()
+
+
+async def run_turns(chatgpt, turns, concurrency, channels):
+    latencies = []
+    queue = asyncio.Queue()
+    for i in range(turns):
+        queue.put_nowait(i)
+
+    async def worker(channel_id):
+        while not queue.empty():
+            i = queue.get_nowait()
+            start = time.perf_counter()
+            await chatgpt.asend_message(QUESTIONS[i % len(QUESTIONS)], channel_id)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(channels[i % len(channels)]) for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    # let background pinning requests finish before the loop closes
+    await asyncio.gather(*chatgpt.background_tasks, return_exceptions=True)
+    await close_async_client()
+    return latencies, elapsed
+
+
+def run_scenario(configs, backend, fake, args, history, table, run_id):
+    partition = f"bench-{run_id}-{table}"
+    prefill_memory(backend, partition, table)
+    config = {
+        "gpt_model": "gpt-3.5-turbo-16k",
+        "max_short_term_memory": max(history, 4),
+        "short_term_memory_max_tokens": 12000,
+        "disable_long_term_memory": False,
+        "disable_self_pinning": False,
+        "partition": partition,
+        **args.config,
+    }
+    configs.set_config(BOT_NAME, config)
+    chatgpt = ChatGPT(configs, BOT_NAME, memory_backend=backend)
+    channels = list(range(args.concurrency))
+    for channel_id in channels:
+        prefill_history(chatgpt, channel_id, history)
+
+    wait_for_background()
+    fake.reset()
+    latencies, elapsed = asyncio.run(run_turns(chatgpt, args.turns, args.concurrency, channels))
+    wait_for_background()
+    counts = fake.stats()
+    chat_calls = counts["chat"] + counts["function_call"] + counts["stream"]
+    return {
+        "history": history,
+        "table": table,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "throughput": len(latencies) / elapsed,
+        "chat_per_turn": chat_calls / len(latencies),
+        "embedding_per_turn": counts["embedding"] / len(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--history", type=int, nargs="+", default=[0, 20, 100])
+    parser.add_argument("--table", type=int, nargs="+", default=[0, 1000, 10000])
+    parser.add_argument("--chat-latency", type=float, default=400, help="milliseconds")
+    parser.add_argument("--embedding-latency", type=float, default=50, help="milliseconds")
+    parser.add_argument("--config", type=json.loads, default={}, help="JSON bot config overrides")
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    args = parser.parse_args()
+
+    fake = FakeOpenAI(chat_latency=args.chat_latency / 1000, embedding_latency=args.embedding_latency / 1000)
+    openai.api_base = start_in_thread(fake)
+
+    db = DB()
+    backend = create_memory_backend(db)
+    if db.disabled:
+        configs = BenchmarkConfigs()
+    else:
+        configs = db
+        if BOT_NAME not in db.bot_configs:
+            db.insert_config(BOT_NAME, {})
+            db.reinitialize()
+    run_id = int(time.time())
+
+    if not args.json:
+        print(f"backend: {type(backend).__name__}, turns: {args.turns}, concurrency: {args.concurrency}")
+        print(f"{'history':>8} {'table':>7} {'p50':>9} {'p95':>9} {'p99':>9} {'turns/s':>8} {'chat/turn':>10} {'embed/turn':>11}")
+    for history in args.history:
+        for table in args.table:
+            result = run_scenario(configs, backend, fake, args, history, table, run_id)
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print(
+                    f"{result['history']:>8} {result['table']:>7} {result['p50']:>7.1f}ms {result['p95']:>7.1f}ms "
+                    f"{result['p99']:>7.1f}ms {result['throughput']:>8.2f} {result['chat_per_turn']:>10.2f} "
+                    f"{result['embedding_per_turn']:>11.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Micro-benchmark for prompt packing: re-counting the whole message list per
+candidate (the old approach) against the incremental TokenBudget.
+
+    python benchmarks/token_budget.py
+"""
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+os.environ.setdefault("DISCORD_BOT_TOKEN", "benchmark")
+os.environ.setdefault("DISCORD_USERS", "benchmark")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+import openai_tools
+from openai_tools import TokenBudget, num_tokens_from_messages
+
+MODEL = "gpt-3.5-turbo-16k"
+WORDS = "the quick brown fox jumps over a lazy dog while users ask about memory and context".split()
+
+
+def make_history(n, seed=0):
+    rng = random.Random(seed)
+    return [
+        {
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 80))),
+        }
+        for i in range(n)
+    ]
+
+
+def pack_quadratic(history, limit):
+    packed = []
+    for msg in reversed(history):
+        if num_tokens_from_messages(packed + [msg], MODEL) <= limit:
+            packed.append(msg)
+        else:
+            break
+    return packed
+
+
+def pack_incremental(history, limit):
+    packed = []
+    budget = TokenBudget(MODEL, limit)
+    for msg in reversed(history):
+        if budget.add([msg]):
+            packed.append(msg)
+        else:
+            break
+    return packed
+
+
+def clear_caches():
+    openai_tools.num_tokens_from_text.cache_clear()
+
+
+def bench(func, history, limit, cold):
+    if cold:
+        clear_caches()
+    start = time.perf_counter()
+    packed = func(history, limit)
+    return time.perf_counter() - start, len(packed)
+
+
+if __name__ == "__main__":
+    history = make_history(2000)
+    num_tokens_from_messages(history[:1], MODEL)  # load the encoding once
+    print(f"{'context':>8} {'messages':>9} {'quadratic':>11} {'incremental (cold)':>19} {'incremental (warm)':>19}")
+    for limit in (16384, 32768):
+        quadratic, n = bench(pack_quadratic, history, limit, cold=True)
+        cold, m = bench(pack_incremental, history, limit, cold=True)
+        warm, _ = bench(pack_incremental, history, limit, cold=False)
+        assert n == m
+        print(f"{limit:>8} {n:>9} {quadratic * 1000:>9.1f}ms {cold * 1000:>17.1f}ms {warm * 1000:>17.1f}ms")
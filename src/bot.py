@@ -1,13 +1,21 @@
 import os
 import json
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
-from config import DISCORD_USERS, DISABLED, get_logger
+from config import DISCORD_USERS, DISABLED, MAX_CHAT_WORKERS, MAX_PENDING_CHATS, METRICS_HOST, METRICS_PORT, get_logger
 
 logger = get_logger(__name__)
 
 import discord
 from gpt import ChatGPT
 from db import DB
+from openai_tools import close_async_client
+from short_term_memory import create_short_term_store
+from memory_backend import create_memory_backend
+from metrics import metrics, start_metrics_server
+from compaction import compaction_scheduler
 
 def logger_decorator(func):
     async def wrapper(self, message):
@@ -17,13 +25,180 @@ def logger_decorator(func):
             logger.error(e)
     return wrapper
 
+MESSAGE_LIMIT = 2000
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    """
+    Breaks text up into chunks that fit in a Discord message.
+    """
+    return [text[i:i + limit] for i in range(0, len(text), limit)] or [""]
+
+class StreamingReply:
+    """
+    Shows a streamed response as it arrives.
+
+    A placeholder message is sent first and edited with the text received so
+    far, at most once every `interval` seconds. Text past Discord's message
+    limit continues in new messages.
+    """
+    placeholder = "..."
+
+    def __init__(self, channel, interval=1.0):
+        self.channel = channel
+        self.interval = interval
+        self.messages = []
+        self.last_update = 0
+
+    async def start(self):
+        self.messages.append(await self.channel.send(self.placeholder))
+        self.last_update = time.monotonic()
+
+    async def update(self, text):
+        if time.monotonic() - self.last_update < self.interval:
+            return
+        await self.render(text)
+
+    async def finish(self, text):
+        await self.render(text)
+        # the cleaned response may be shorter than what was streamed
+        num_chunks = len(split_message(text))
+        extra = self.messages[num_chunks:]
+        del self.messages[num_chunks:]
+        for message in extra:
+            await message.delete()
+
+    async def fail(self):
+        """
+        Cleans up after a failed response: messages still showing only the
+        placeholder are deleted, any text already streamed is left as is.
+        """
+        for message in [message for message in self.messages if message.content == self.placeholder]:
+            self.messages.remove(message)
+            try:
+                await message.delete()
+            except discord.HTTPException as e:
+                logger.error(f"Could not delete placeholder message: {e}")
+
+    async def render(self, text):
+        self.last_update = time.monotonic()
+        for i, chunk in enumerate(split_message(text)):
+            chunk = chunk or self.placeholder
+            if i < len(self.messages):
+                if self.messages[i].content != chunk:
+                    self.messages[i] = await self.messages[i].edit(content=chunk)
+            else:
+                self.messages.append(await self.channel.send(chunk))
+
+class ChannelDispatcher:
+    """
+    Runs chat work in order per channel.
+
+    Each channel gets its own ordered queue, drained by a single worker task,
+    so replies within a channel keep their order while different channels run
+    concurrently. Replies are limited per bot by a semaphore, and the total
+    number of queued or running jobs is capped to apply backpressure to
+    incoming messages. `executor` is a thread pool bounded by
+    MAX_CHAT_WORKERS, installed as the loop's default executor so the
+    blocking calls made with `asyncio.to_thread` (channel loads, recalls,
+    cache lookups) share its limit.
+    """
+    def __init__(self, max_workers=MAX_CHAT_WORKERS, max_pending=MAX_PENDING_CHATS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chat")
+        self.pending = asyncio.Semaphore(max_pending)
+        self.queues = {}
+        self.workers = {}
+        self.bot_limits = {}
+
+    async def submit(self, channel_id, job):
+        """
+        Queues a job (a coroutine function) to run in order for the given channel.
+        Waits while the global pending limit is reached.
+        """
+        await self.pending.acquire()
+        queue = self.queues.get(channel_id)
+        if queue is None:
+            queue = self.queues[channel_id] = asyncio.Queue()
+        queue.put_nowait(job)
+        if channel_id not in self.workers:
+            self.workers[channel_id] = asyncio.create_task(self.drain(channel_id))
+
+    async def drain(self, channel_id):
+        queue = self.queues[channel_id]
+        try:
+            while not queue.empty():
+                job = queue.get_nowait()
+                try:
+                    await job()
+                except Exception as e:
+                    logger.error(e)
+                finally:
+                    self.pending.release()
+        finally:
+            del self.workers[channel_id]
+            del self.queues[channel_id]
+
+    def bot_limit(self, bot_name, concurrency):
+        """
+        Returns the semaphore allowing at most `concurrency` calls for the given bot at once.
+        """
+        limit, semaphore = self.bot_limits.get(bot_name, (None, None))
+        if limit != concurrency:
+            semaphore = asyncio.Semaphore(concurrency)
+            self.bot_limits[bot_name] = (concurrency, semaphore)
+        return semaphore
+
+    async def run_async(self, bot_name, concurrency, func, *args):
+        """
+        Awaits a coroutine function directly on the loop, within the bot's concurrency limit.
+        """
+        async with self.bot_limit(bot_name, concurrency):
+            return await func(*args)
+
+    def queue_depths(self):
+        return {channel_id: queue.qsize() for channel_id, queue in self.queues.items()}
+
 class BotClient(discord.Client):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.db = DB()
         self.chatgpts = {}
         self.message_cutoff = 200
+        self.dispatcher = ChannelDispatcher()
+        self.short_term_store = create_short_term_store(self.db)
+        self.memory_backend = create_memory_backend(self.db)
+        self.metrics_runner = None
+        metrics.register_gauge("chat_queue", self.queue_stats, "Chats waiting in channel queues, and channels with queued chats.")
+        metrics.register_gauge("response_cache", self.response_cache_stats, "Response cache entries and hit counts per bot.")
+
+    def queue_stats(self):
+        depths = self.dispatcher.queue_depths()
+        stats = [({"stat": "queued"}, sum(depths.values())), ({"stat": "channels"}, len(depths))]
+        if self.short_term_store:
+            stats.append(({"stat": "short_term_unflushed"}, len(self.short_term_store.dirty)))
+        return stats
+
+    def response_cache_stats(self):
+        return [
+            ({"bot": bot_name, "stat": stat}, value)
+            for bot_name, chatgpt in list(self.chatgpts.items())
+            if chatgpt.response_cache
+            for stat, value in chatgpt.response_cache.stats().items()
+        ]
+
+    async def setup_hook(self):
+        # asyncio.to_thread runs on the default executor
+        asyncio.get_running_loop().set_default_executor(self.dispatcher.executor)
+        if METRICS_PORT:
+            self.metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
     
+    async def close(self):
+        if self.metrics_runner:
+            await self.metrics_runner.cleanup()
+        await close_async_client()
+        if self.short_term_store:
+            await asyncio.to_thread(self.short_term_store.flush)
+        await super().close()
+
     async def on_ready(self):
         logger.info(f"Logged on as {self.user}")
     
@@ -35,7 +210,13 @@ class BotClient(discord.Client):
         if message.author == self.user:
             return
 
-        logger.info(f"> {message.author} ({message.channel.id}): {message.content}")
+        metrics.increment("messages_received")
+
+        logger.info(
+            f"Message from {message.author} in {message.channel.id}",
+            extra={"sample": True, "author": str(message.author), "channel_id": message.channel.id},
+        )
+        logger.debug(f"> {message.author} ({message.channel.id}): {message.content}")
 
         if message.author.name in DISCORD_USERS:
             # admin commands
@@ -48,69 +229,106 @@ class BotClient(discord.Client):
                 return
 
         bot_configs = self.db.bot_configs
-        for bot_name in bot_configs:
-            config = bot_configs[bot_name]
-            channel_ids = config.get("channel_ids", None)
-            if isinstance(channel_ids, str):
-                channel_ids = json.loads(channel_ids)
-            if channel_ids is None or message.channel.id in channel_ids:
-                if bot_name not in self.chatgpts:
-                    self.chatgpts[bot_name] = ChatGPT(db=self.db, name=bot_name)
-                if config.get("include_username", False):
-                    message.content = f"[{message.author.name}]: {message.content}"
-                    logger.debug(f"Added username to message: {message.content}")
-                if config.get("reply_to_mentions_only", False):
-                    if self.user.mentioned_in(message):
-                        # remove the mention from the message
-                        message.content = message.content.replace(f"<@{self.user.id}>", "")
-                        logger.debug(f"Removed mention from message: {message.content}")
-                    else:
-                        return
-                chatgpt = self.chatgpts[bot_name]
-                if "!pin" in message.content:
-                    index_of_pin = message.content.index("!pin")
-                    message_to_pin = message.content[index_of_pin + 4:].strip()
-                    if message_to_pin != "":
-                        logger.debug(f"Pinning manual message: {message_to_pin}")
-                        chatgpt.pin_message(message_to_pin)
-                    await message.channel.send(f"Message pinned: {chatgpt.pinned_message}")
-                    return
-                if "!unpin" in message.content:
-                    logger.debug("Unpinning message...")
-                    chatgpt.pin_message(None)
-                    await message.channel.send(f"Message unpinned.")
-                    return
-                if "!recall" in message.content:
-                    logger.debug("Recalling message...")
-                    await message.channel.send(f"Short term memory: ```{chatgpt.short_term_memory}```")
-                    return
-                if "!forget" in message.content:
-                    chatgpt.short_term_memory = []
-                    logger.debug("Short term memory cleared.")
-                    await message.channel.send(f"Short term memory cleared.")
+        for bot_name in self.db.get_channel_bots(message.channel.id):
+            config = bot_configs.get(bot_name, None)
+            if config is None:
+                # removed by a config change since the routes were read
+                continue
+            if config.get("include_username", False):
+                message.content = f"[{message.author.name}]: {message.content}"
+                logger.debug(f"Added username to message: {message.content}")
+            if config.get("reply_to_mentions_only", False):
+                if self.user.mentioned_in(message):
+                    # remove the mention from the message
+                    message.content = message.content.replace(f"<@{self.user.id}>", "")
+                    logger.debug(f"Removed mention from message: {message.content}")
+                else:
                     return
-                if "!help" in message.content:
-                    logger.debug("Sending help message...")
-                    await message.channel.send(
-                        f"""Commands:
+            chatgpt = self.get_chatgpt(bot_name)
+            if "!pin" in message.content:
+                index_of_pin = message.content.index("!pin")
+                message_to_pin = message.content[index_of_pin + 4:].strip()
+                if message_to_pin != "":
+                    logger.debug(f"Pinning manual message: {message_to_pin}")
+                    await asyncio.to_thread(chatgpt.pin_message, message_to_pin, message.channel.id)
+                memory = await asyncio.to_thread(chatgpt.get_short_term_memory, message.channel.id)
+                await message.channel.send(f"Message pinned: {memory.pinned_message}")
+                return
+            if "!unpin" in message.content:
+                logger.debug("Unpinning message...")
+                await asyncio.to_thread(chatgpt.pin_message, None, message.channel.id)
+                await message.channel.send(f"Message unpinned.")
+                return
+            if "!recall" in message.content:
+                logger.debug("Recalling message...")
+                memory = await asyncio.to_thread(chatgpt.get_short_term_memory, message.channel.id)
+                await message.channel.send(f"Short term memory: ```{memory}```")
+                return
+            if "!forget" in message.content:
+                await asyncio.to_thread(chatgpt.clear_short_term_memory, message.channel.id)
+                logger.debug("Short term memory cleared.")
+                await message.channel.send(f"Short term memory cleared.")
+                return
+            if "!help" in message.content:
+                logger.debug("Sending help message...")
+                await message.channel.send(
+                    f"""Commands:
                             `!recall`: Shows short term memory
                             `!forget`: Clears short term memory
                             `!pin`: Shows the pinned message
                             `!pin <message>`: Pins a message
                             `!unpin`: Unpins the message
                             `!help`: Shows this message"""
-                    )
-                    return
-                logger.debug("Chatting with GPT...")
-                await self.chat(message, chatgpt)
+                )
+                return
+            logger.debug("Chatting with GPT...")
+            content = message.content
+            await self.dispatcher.submit(
+                message.channel.id,
+                lambda chatgpt=chatgpt, content=content: self.chat(message, chatgpt, content),
+            )
 
-    async def chat(self, message, chatgpt):
-        await message.channel.typing()
+    def get_chatgpt(self, bot_name):
+        """
+        Returns the bot's ChatGPT, creating it on first use.
+        """
+        if bot_name not in self.chatgpts:
+            self.chatgpts[bot_name] = ChatGPT(
+                db=self.db, name=bot_name, store=self.short_term_store, memory_backend=self.memory_backend
+            )
+        return self.chatgpts[bot_name]
+
+    async def chat(self, message, chatgpt, content=None):
+        if content is None:
+            content = message.content
         logger.debug("Sending message to GPT...")
-        response_message = chatgpt.send_message(message.content)
+        concurrency = int(chatgpt.config.get("max_concurrency", 4))
+        if chatgpt.config.get("stream_responses", False):
+            reply = StreamingReply(
+                message.channel, float(chatgpt.config.get("stream_edit_interval", 1.0))
+            )
+            await reply.start()
+            try:
+                response_message = await self.dispatcher.run_async(
+                    chatgpt.name, concurrency, chatgpt.asend_message, content, message.channel.id, reply.update
+                )
+                await reply.finish(response_message)
+            except Exception:
+                await reply.fail()
+                raise
+        else:
+            await message.channel.typing()
+            response_message = await self.dispatcher.run_async(
+                chatgpt.name, concurrency, chatgpt.asend_message, content, message.channel.id
+            )
+            for chunk in split_message(response_message):
+                await message.channel.send(chunk)
         bot_name = chatgpt.name
-        logger.info(f"> {bot_name}: {response_message}")
-        await message.channel.send(response_message)
+        logger.info(
+            f"Replied as {bot_name} in {message.channel.id}",
+            extra={"sample": True, "bot": bot_name, "channel_id": message.channel.id},
+        )
+        logger.debug(f"> {bot_name}: {response_message}")
 
     async def run_command(self, message):
         command = message.content[1:]
@@ -127,24 +345,26 @@ class BotClient(discord.Client):
                         bot_names = list(self.db.bot_configs.keys())
                         response = json.dumps(bot_names, indent=4)
                         response = f"```json\n{response}\n```"
+                    if args[1] == "stats":
+                        response = f"```\n{metrics.summary()}\n```"
                 if len(args) == 3:
                     if args[1] == "config":
                         bot_name = args[2]
-                        self.db.get_bot_configs()
                         response = self.prepare_config_response(bot_name)
                     if args[1] == "short_term_memory":
                         bot_name = args[2]
-                        response = self.chatgpts[bot_name].short_term_memory
+                        channels = self.chatgpts[bot_name].channels
+                        response = {str(channel_id): list(memory) for channel_id, memory in channels.items()}
                         response = f"```json\n{response}\n```"
                     if args[1] == "pinned_message":
                         bot_name = args[2]
-                        response = self.chatgpts[bot_name].pinned_message
+                        channels = self.chatgpts[bot_name].channels
+                        response = {str(channel_id): memory.pinned_message for channel_id, memory in channels.items()}
                         response = f"```json\n{response}\n```"
                 if len(args) == 4:
                     if args[1] == "config":
                         bot_name = args[2]
                         config_key = args[3]
-                        self.db.get_bot_configs()
                         response = json.dumps(self.db.bot_configs[bot_name][config_key], indent=4)
                         response = f"```json\n{response}\n```"
 
@@ -157,7 +377,6 @@ class BotClient(discord.Client):
                             config_text = " ".join(args[3:])
                             config = json.loads(config_text)
                             self.db.set_config(bot_name, config)
-                            self.db.get_bot_configs()
                             response = self.prepare_config_response(bot_name)
                         elif len(files) > 0:
                             # assume we've uploaded a message.txt file
@@ -168,18 +387,16 @@ class BotClient(discord.Client):
                             with open(file_path, "r") as f:
                                 update_value = f.read()
                             config_key = args[3]
-                            config = self.db.bot_configs[bot_name]
+                            config = dict(self.db.bot_configs[bot_name])
                             config[config_key] = update_value
                             self.db.set_config(bot_name, config)
-                            self.db.get_bot_configs()
                             response = self.prepare_config_response(bot_name)
                         else:
                             config_key = args[3]
                             config_value = " ".join(args[4:])
-                            config = self.db.bot_configs[bot_name]
+                            config = dict(self.db.bot_configs[bot_name])
                             config[config_key] = config_value
                             self.db.set_config(bot_name, config)
-                            self.db.get_bot_configs()
                             response = self.prepare_config_response(bot_name)
 
             if args[0] == "insert":
@@ -187,18 +404,51 @@ class BotClient(discord.Client):
                     if args[1] == "config":
                         bot_name = args[2]
                         self.db.insert_config(bot_name, {})
-                        self.db.get_bot_configs()
                         response = self.prepare_config_response(bot_name)
             
-            if args[0] == "reset":
+            if args[0] == "compact":
+                if len(args) == 3:
+                    if args[1] == "memory":
+                        bot_name = args[2]
+                        if bot_name not in self.db.bot_configs:
+                            response = f"No config found for {bot_name}."
+                        else:
+                            memory = self.get_chatgpt(bot_name).long_term_memory
+                            report = await asyncio.to_thread(
+                                compaction_scheduler.compact, (memory.name, memory.partition), memory
+                            )
+                            if report is None:
+                                response = f"Could not compact memory for {bot_name}, see the logs."
+                            else:
+                                response = json.dumps(report, indent=4)
+                                response = f"```json\n{response}\n```"
+
+            if args[0] == "migrate":
+                if len(args) == 3:
+                    if args[1] == "memory":
+                        bot_name = args[2]
+                        count = await asyncio.to_thread(self.db.migrate_memory, bot_name)
+                        response = f"Migrated {count} memories for {bot_name}."
+
+            if args[0] == "reload":
                 if len(args) == 2:
+                    if args[1] == "config":
+                        self.db.reinitialize()
+                        response = "Configs reloaded."
+
+            if args[0] == "reset":
+                if len(args) == 3:
                     if args[1] == "short_term_memory":
                         bot_name = args[2]
-                        self.chatgpts[bot_name].short_term_memory = []
+                        chatgpt = self.chatgpts[bot_name]
+                        for channel_id in list(chatgpt.channels):
+                            chatgpt.clear_short_term_memory(channel_id)
                         response = "Short term memory reset."
                     if args[1] == "pinned_message":
                         bot_name = args[2]
-                        self.chatgpts[bot_name].pinned_message = []
+                        chatgpt = self.chatgpts[bot_name]
+                        for channel_id in list(chatgpt.channels):
+                            chatgpt.pin_message(None, channel_id)
                         response = "Pinned message reset."
                 else:
                     self.chatgpts = {}
@@ -210,16 +460,9 @@ class BotClient(discord.Client):
         if response is None:
             return
         
-        if len(response) > 2000:
-            # break up the response into multiple messages
-            response_messages = []
-            while len(response) > 0:
-                response_messages.append(response[:2000])
-                response = response[2000:]
-            for response_message in response_messages:
-                await message.channel.send(response_message)
-        else:
-            await message.channel.send(response)
+        # break up the response into multiple messages
+        for response_message in split_message(response):
+            await message.channel.send(response_message)
 
     async def run_system_command(self, message):
         command = message.content[2:]
@@ -235,7 +478,7 @@ class BotClient(discord.Client):
     
     def prepare_config_response(self, bot_name):
         self.message_cutoff
-        config = self.db.bot_configs[bot_name]
+        config = dict(self.db.bot_configs[bot_name])
         for key, value in config.items():
             if len(str(value)) > self.message_cutoff:
                 config[key] = str(value)[:self.message_cutoff] + "..."
@@ -0,0 +1,61 @@
+import time
+import threading
+
+from config import get_logger
+
+logger = get_logger(__name__)
+
+class CompactionScheduler:
+    """
+    Runs each registered Memory's `compact` on a background thread every
+    `compaction_interval` hours, one at a time.
+
+    Memories are keyed by (bot, partition); registering a new Memory for the
+    same key replaces the old one, keeping its schedule.
+    """
+    def __init__(self, poll_interval=60):
+        self.poll_interval = poll_interval
+        # (bot, partition) -> Memory
+        self.memories = {}
+        # (bot, partition) -> time.monotonic() of the last compaction
+        self.last_run = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def register(self, memory):
+        key = (memory.name, memory.partition)
+        with self.lock:
+            self.memories[key] = memory
+            self.last_run.setdefault(key, time.monotonic())
+            if memory.compaction_interval > 0 and self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="compaction", daemon=True)
+                self.thread.start()
+
+    def due(self):
+        now = time.monotonic()
+        with self.lock:
+            return [
+                (key, memory)
+                for key, memory in self.memories.items()
+                if memory.compaction_interval > 0
+                and now - self.last_run[key] >= memory.compaction_interval * 3600
+            ]
+
+    def run(self):
+        while True:
+            time.sleep(self.poll_interval)
+            for key, memory in self.due():
+                self.compact(key, memory)
+
+    def compact(self, key, memory):
+        try:
+            report = memory.compact()
+        except Exception as e:
+            logger.error(f"Compaction: Failed for {key}: {e}")
+            report = None
+        with self.lock:
+            self.last_run[key] = time.monotonic()
+        return report
+
+
+compaction_scheduler = CompactionScheduler()
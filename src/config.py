@@ -1,6 +1,11 @@
 import os
 import sys
+import json
+import queue
+import atexit
+import random
 import logging
+import threading
 import logging.handlers
 from dotenv import load_dotenv
 
@@ -16,18 +21,110 @@ DISCORD_BOT_TOKEN = get_env_variable("DISCORD_BOT_TOKEN")
 DISCORD_USERS = get_env_variable("DISCORD_USERS").split(",")
 OPENAI_API_KEY = get_env_variable("OPENAI_API_KEY")
 DB_URI = get_env_variable("DB_URI", default=None, required=False)
+DB_STORAGE_MODE = get_env_variable("DB_STORAGE_MODE", default="per_bot", required=False).lower()
+DB_POOL_MIN_SIZE = int(get_env_variable("DB_POOL_MIN_SIZE", default="2", required=False))
+DB_POOL_MAX_SIZE = int(get_env_variable("DB_POOL_MAX_SIZE", default="10", required=False))
 LOG_LEVEL = get_env_variable("LOG_LEVEL", default="INFO", required=False)
 INSTANCE_ID = get_env_variable("INSTANCE_ID", default="default", required=False)
 DISABLED = get_env_variable("DISABLED", default="false", required=False).lower() == "true"
+CONFIG_LISTEN = get_env_variable("CONFIG_LISTEN", default="true", required=False).lower() == "true"
+MAX_CHAT_WORKERS = int(get_env_variable("MAX_CHAT_WORKERS", default="8", required=False))
+MAX_PENDING_CHATS = int(get_env_variable("MAX_PENDING_CHATS", default="64", required=False))
+OPENAI_MAX_CONNECTIONS = int(get_env_variable("OPENAI_MAX_CONNECTIONS", default="32", required=False))
+OPENAI_CHAT_CONCURRENCY = int(get_env_variable("OPENAI_CHAT_CONCURRENCY", default="8", required=False))
+OPENAI_EMBEDDING_CONCURRENCY = int(get_env_variable("OPENAI_EMBEDDING_CONCURRENCY", default="16", required=False))
+OPENAI_MAX_RETRIES = int(get_env_variable("OPENAI_MAX_RETRIES", default="3", required=False))
+EMBEDDING_CACHE_MAX_BYTES = int(get_env_variable("EMBEDDING_CACHE_MAX_BYTES", default=str(64 * 1024 * 1024), required=False))
+EMBEDDING_CACHE_PATH = get_env_variable("EMBEDDING_CACHE_PATH", default=None, required=False)
+EMBEDDING_CACHE_MAX_DISK_BYTES = int(get_env_variable("EMBEDDING_CACHE_MAX_DISK_BYTES", default=str(1024 * 1024 * 1024), required=False))
+EMBEDDING_BATCH_WINDOW_MS = float(get_env_variable("EMBEDDING_BATCH_WINDOW_MS", default="5", required=False))
+EMBEDDING_BATCH_MAX_SIZE = int(get_env_variable("EMBEDDING_BATCH_MAX_SIZE", default="256", required=False))
+SHORT_TERM_STORE = get_env_variable("SHORT_TERM_STORE", default="auto", required=False).lower()
+SHORT_TERM_STORE_PATH = get_env_variable("SHORT_TERM_STORE_PATH", default="short_term_memory", required=False)
+SHORT_TERM_FLUSH_INTERVAL = float(get_env_variable("SHORT_TERM_FLUSH_INTERVAL", default="5", required=False))
+MEMORIZE_WORKERS = int(get_env_variable("MEMORIZE_WORKERS", default="4", required=False))
+REFLECTION_WORKERS = int(get_env_variable("REFLECTION_WORKERS", default="2", required=False))
+REFLECTION_MAX_PENDING = int(get_env_variable("REFLECTION_MAX_PENDING", default="32", required=False))
+MEMORY_BACKEND = get_env_variable("MEMORY_BACKEND", default="auto", required=False).lower()
+LOCAL_MEMORY_PATH = get_env_variable("LOCAL_MEMORY_PATH", default="long_term_memory", required=False)
+LOCAL_MEMORY_DTYPE = get_env_variable("LOCAL_MEMORY_DTYPE", default="float32", required=False)
+REFLECTION_DROP_POLICY = get_env_variable("REFLECTION_DROP_POLICY", default="oldest", required=False).lower()
+METRICS_HOST = get_env_variable("METRICS_HOST", default="127.0.0.1", required=False)
+METRICS_PORT = int(get_env_variable("METRICS_PORT", default="0", required=False))
+
+LOG_FORMAT = get_env_variable("LOG_FORMAT", default="text", required=False).lower()
+LOG_FILE = get_env_variable("LOG_FILE", default="bot.log", required=False)
+LOG_SAMPLE_RATE = float(get_env_variable("LOG_SAMPLE_RATE", default="1.0", required=False))
+
+# attributes every LogRecord has, so anything else was passed with `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "sample"}
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line, including any fields passed
+    with `extra`.
+    """
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "logger": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class SampleFilter(logging.Filter):
+    """
+    Passes only a `rate` fraction of records logged with `extra={"sample": True}`,
+    for logs written on every message. Other records always pass.
+    """
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if getattr(record, "sample", False):
+            return self.rate >= 1 or random.random() < self.rate
+        return True
+
+_log_lock = threading.Lock()
+_log_handler = None
+
+def get_log_handler():
+    """
+    Returns the QueueHandler shared by every logger, starting the listener
+    thread that writes records to stdout and LOG_FILE the first time.
+    Logging calls only put the record on a queue, so file and console I/O
+    never happens on the event loop or the calling thread.
+    """
+    global _log_handler
+    with _log_lock:
+        if _log_handler is None:
+            if LOG_FORMAT == "json":
+                formatter = JsonFormatter()
+            else:
+                formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+            stream_handler = logging.StreamHandler(sys.stdout)
+            stream_handler.setFormatter(formatter)
+            file_handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=10 * 1024 * 1024, backupCount=5)
+            file_handler.setFormatter(formatter)
+            log_queue = queue.SimpleQueue()
+            listener = logging.handlers.QueueListener(log_queue, stream_handler, file_handler)
+            listener.start()
+            atexit.register(listener.stop)
+            _log_handler = logging.handlers.QueueHandler(log_queue)
+            _log_handler.addFilter(SampleFilter(LOG_SAMPLE_RATE))
+        return _log_handler
 
 def get_logger(logger_name):
     logger = logging.getLogger(logger_name)
     logger.setLevel(LOG_LEVEL.upper())
-    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    handler = logging.handlers.RotatingFileHandler("bot.log", maxBytes=10 * 1024 * 1024, backupCount=5)
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    handler = get_log_handler()
+    if handler not in logger.handlers:
+        logger.addHandler(handler)
     return logger
@@ -1,29 +1,149 @@
 import json
+import time
+import hashlib
+import threading
+from datetime import datetime
+from types import MappingProxyType
 
+import numpy as np
+import psycopg
+from psycopg import sql
+from psycopg.types.json import Jsonb
 from psycopg_pool import ConnectionPool
 from pgvector.psycopg import register_vector
 
-from config import DB_URI, get_logger
+from config import DB_URI, DB_STORAGE_MODE, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, CONFIG_LISTEN, get_logger
+from memory_backend import MemoryBackend, dump_metadata, plan_compaction
+from metrics import metrics
 
 logger = get_logger(__name__)
 
-class DB:
+MEMORY_INDEX_OPS = {
+    "hnsw": "vector_l2_ops",
+    "ivfflat": "vector_l2_ops",
+}
+
+# ivfflat picks its list centers from the rows present when it is built, so
+# it is only built once a partition has this many rows per list
+IVFFLAT_MIN_ROWS_PER_LIST = 10
+# pgvector's upper limit for hnsw.ef_search, which bounds how many rows an
+# HNSW scan can return: recalls asking for more candidates get at most this many
+HNSW_MAX_EF_SEARCH = 1000
+# seconds between checks of whether a deferred index can be built
+DEFERRED_INDEX_RETRY_INTERVAL = 60
+
+# Postgres truncates identifiers longer than NAMEDATALEN - 1 bytes
+MAX_IDENTIFIER_LENGTH = 63
+
+def parse_timestamp(timestamp):
+    # metadata read back from JSONB holds timestamps as strings
+    if isinstance(timestamp, str):
+        return datetime.fromisoformat(timestamp)
+    return timestamp
+
+def parse_channel_ids(channel_ids):
+    if isinstance(channel_ids, str):
+        channel_ids = json.loads(channel_ids)
+    return channel_ids
+
+def partition_filter(partition):
+    """
+    Returns the WHERE clause selecting a memory partition. The partition is
+    inlined as a literal so the planner can match it against partial indexes.
+    """
+    if partition is None:
+        return sql.SQL("partition IS NULL")
+    return sql.SQL("partition = {}").format(sql.Literal(partition))
+
+def short_identifier(identifier, prefix):
+    """
+    Returns the identifier, or `prefix` followed by an md5 of it if it's
+    longer than Postgres allows: a truncated name could collide with another
+    bot's or partition's table or index.
+    """
+    if len(identifier.encode("utf-8")) <= MAX_IDENTIFIER_LENGTH:
+        return identifier
+    return f"{prefix}_{hashlib.md5(identifier.encode('utf-8')).hexdigest()}"
+
+class DB(MemoryBackend):
+    supports_ranking = True
+
     def __init__(self):
         self.disabled = DB_URI is None
+        self.bot_configs = {}
+        self.channel_routes = {}
+        self.wildcard_bots = []
+        self.config_version = 0
+        self.bot_config_versions = {}
+        self.config_lock = threading.RLock()
         if self.disabled:
             logger.warning("DB: DB_URI is not set, disabling database...")
             return
         self.memory_dimension = 1536
-        self.config_pool = ConnectionPool(DB_URI + "/config")
+        # "per_bot" keeps each bot's memory in its own database with its own
+        # pool; "shared" keeps every bot's memory in one list-partitioned table
+        # in the config database, served by a single pool
+        self.shared = DB_STORAGE_MODE == "shared"
+        if self.shared:
+            self.config_pool = ConnectionPool(DB_URI + "/config", min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE)
+        else:
+            self.config_pool = ConnectionPool(DB_URI + "/config")
         self.bot_pools = {}
+        self.indexed_partitions = {}
+        self.deferred_indexes = {}
+        self.building_indexes = set()
+        self.index_lock = threading.Lock()
         self.setup_config_database()
-        self.bot_configs = self.get_bot_configs()
+        if self.shared:
+            self.setup_shared_memory_database()
+        self.get_bot_configs()
         for bot_name in self.bot_configs:
-            self.bot_pools[bot_name] = ConnectionPool(DB_URI + f"/{bot_name}")
-            self.setup_bot_database(bot_name)
+            self.setup_bot_pool(bot_name)
+        if CONFIG_LISTEN:
+            threading.Thread(target=self.listen_for_config_changes, name="config-listener", daemon=True).start()
+        metrics.register_gauge("db_pool", self.pool_stats, "Connection pool sizes, waiting requests and cumulative wait time.")
+
+    def pool_stats(self):
+        pools = {"config": self.config_pool}
+        for name, pool in list(self.bot_pools.items()):
+            if pool is not self.config_pool:
+                pools[name] = pool
+        return [
+            ({"pool": name, "stat": stat}, value)
+            for name, pool in pools.items()
+            for stat, value in pool.get_stats().items()
+        ]
 
     def reinitialize(self):
-        self.__init__()
+        """
+        Reloads every config, opening pools for new bots and closing the pools
+        of bots that were removed.
+        """
+        self.get_bot_configs()
+        for bot_name in self.bot_configs:
+            if bot_name not in self.bot_pools:
+                self.setup_bot_pool(bot_name)
+        for bot_name in list(self.bot_pools):
+            if bot_name not in self.bot_configs:
+                pool = self.bot_pools.pop(bot_name)
+                if pool is not self.config_pool:
+                    pool.close()
+
+    def setup_bot_pool(self, name):
+        if self.shared:
+            self.bot_pools[name] = self.config_pool
+        else:
+            self.bot_pools[name] = ConnectionPool(DB_URI + f"/{name}")
+        self.setup_bot_database(name)
+
+    def memory_table(self, name):
+        """
+        Returns the name of the table holding a bot's memories: `memory` in the
+        bot's own database, or the bot's partition of the shared `memory` table.
+        """
+        if self.shared:
+            return short_identifier(f"memory_{name}", "memory")
+        return "memory"
 
     def setup_config_database(self):
         with self.config_pool.connection() as conn:
@@ -32,26 +152,312 @@ class DB:
                 cur.execute(
                     f"CREATE TABLE IF NOT EXISTS bot (id serial PRIMARY KEY, name varchar(255), config JSONB);"
                 )
+                # notify listeners with the bot's name whenever its config changes
+                cur.execute(
+                    """
+                        CREATE OR REPLACE FUNCTION notify_bot_config() RETURNS trigger AS $$
+                        BEGIN
+                            IF TG_OP = 'DELETE' THEN
+                                PERFORM pg_notify('bot_config', OLD.name);
+                            ELSE
+                                PERFORM pg_notify('bot_config', NEW.name);
+                            END IF;
+                            RETURN NULL;
+                        END;
+                        $$ LANGUAGE plpgsql;
+                    """
+                )
+                cur.execute("DROP TRIGGER IF EXISTS bot_config_notify ON bot;")
+                cur.execute(
+                    """
+                        CREATE TRIGGER bot_config_notify
+                        AFTER INSERT OR UPDATE OR DELETE ON bot
+                        FOR EACH ROW EXECUTE FUNCTION notify_bot_config();
+                    """
+                )
             conn.commit()
 
-    def setup_bot_database(self, name):
-        pool = self.bot_pools[name]
-        with pool.connection() as conn:
+    def listen_for_config_changes(self):
+        """
+        Applies config changes made by any process, as announced by the
+        `bot_config` notifications. Runs forever on a background thread,
+        reconnecting (and reloading every config) if the connection drops.
+        """
+        connected = True
+        while True:
+            try:
+                with psycopg.connect(DB_URI + "/config", autocommit=True) as conn:
+                    conn.execute("LISTEN bot_config;")
+                    if not connected:
+                        # changes may have been missed while disconnected
+                        self.get_bot_configs()
+                    connected = True
+                    logger.debug("DB: Listening for config changes...")
+                    for notify in conn.notifies():
+                        self.refresh_bot_config(notify.payload)
+            except Exception as e:
+                connected = False
+                logger.error(f"DB: Config listener failed: {e}")
+                time.sleep(5)
+
+    @metrics.timed("db.refresh_bot_config")
+    def refresh_bot_config(self, name):
+        """
+        Reloads a single bot's config from the database.
+        """
+        with self.config_pool.connection() as conn:
             with conn.cursor() as cur:
-                logger.debug(f"DB: Setting up bot '{name}' database...")
+                logger.debug(f"DB: Refreshing config for {name}...")
+                cur.execute(
+                    f"SELECT config FROM bot WHERE name = %s ORDER BY id DESC LIMIT 1;",
+                    (name,),
+                )
+                result = cur.fetchone()
+        config = result[0] if result else None
+        if config != self.bot_configs.get(name, None):
+            self.update_bot_config(name, config)
+        # `insert_config` already cached the config of a bot created in this
+        # process, but its database still has to be set up
+        if config is not None and name not in self.bot_pools:
+            try:
+                self.setup_bot_pool(name)
+            except Exception as e:
+                logger.error(f"DB: Could not set up database for {name}: {e}")
+
+    def setup_shared_memory_database(self):
+        with self.config_pool.connection() as conn:
+            with conn.cursor() as cur:
+                logger.debug("DB: Setting up shared memory table...")
                 cur.execute(f"CREATE EXTENSION IF NOT EXISTS vector;")
                 cur.execute(
                     f"""
                         CREATE TABLE IF NOT EXISTS memory (
-                            id bigserial PRIMARY KEY,
+                            id bigserial,
+                            bot varchar(255) NOT NULL,
                             partition varchar(255) DEFAULT null,
                             embedding vector({self.memory_dimension}),
-                            metadata JSONB
+                            metadata JSONB,
+                            importance real,
+                            created_at timestamp,
+                            PRIMARY KEY (bot, id)
+                        ) PARTITION BY LIST (bot);
+                    """
+                )
+            conn.commit()
+
+    def setup_bot_database(self, name):
+        pool = self.bot_pools[name]
+        table = sql.Identifier(self.memory_table(name))
+        with pool.connection() as conn:
+            with conn.cursor() as cur:
+                logger.debug(f"DB: Setting up bot '{name}' database...")
+                if self.shared:
+                    cur.execute(
+                        sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF memory FOR VALUES IN ({});").format(
+                            table, sql.Literal(name)
+                        )
+                    )
+                    # lets the bot's partition be written to directly, like a per-bot table
+                    cur.execute(
+                        sql.SQL("ALTER TABLE {} ALTER COLUMN bot SET DEFAULT {};").format(table, sql.Literal(name))
+                    )
+                else:
+                    cur.execute(f"CREATE EXTENSION IF NOT EXISTS vector;")
+                    cur.execute(
+                        f"""
+                            CREATE TABLE IF NOT EXISTS memory (
+                                id bigserial PRIMARY KEY,
+                                partition varchar(255) DEFAULT null,
+                                embedding vector({self.memory_dimension}),
+                                metadata JSONB
+                            );
+                        """
+                    )
+                    # importance and timestamp are copied out of metadata so they
+                    # can be indexed and used for ranking inside Postgres
+                    cur.execute("ALTER TABLE memory ADD COLUMN IF NOT EXISTS importance real;")
+                    cur.execute("ALTER TABLE memory ADD COLUMN IF NOT EXISTS created_at timestamp;")
+                    cur.execute(
+                        """
+                            UPDATE memory SET
+                                importance = (metadata->>'importance')::real,
+                                created_at = (metadata->>'timestamp')::timestamp
+                            WHERE created_at IS NULL;
+                        """
+                    )
+                # the newest memory each partition's compaction has compared, see `compact_memory`
+                cur.execute(
+                    """
+                        CREATE TABLE IF NOT EXISTS memory_compaction (
+                            memory_table varchar(255),
+                            partition_key text,
+                            last_id bigint NOT NULL,
+                            PRIMARY KEY (memory_table, partition_key)
                         );
                     """
                 )
+                # lets compaction walk a partition's memories in insertion order
+                cur.execute(
+                    sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} (partition, id);").format(
+                        sql.Identifier(short_identifier(f"{self.memory_table(name)}_partition_id_idx", "memory_partition_id_idx")),
+                        table,
+                    )
+                )
+                cur.execute(
+                    sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} (partition, created_at);").format(
+                        sql.Identifier(short_identifier(f"{self.memory_table(name)}_partition_created_at_idx", "memory_created_at_idx")),
+                        table,
+                    )
+                )
+                cur.execute(
+                    sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} (partition, importance);").format(
+                        sql.Identifier(short_identifier(f"{self.memory_table(name)}_partition_importance_idx", "memory_importance_idx")),
+                        table,
+                    )
+                )
             conn.commit()
+        self.indexed_partitions[name] = set()
+        config = self.bot_configs.get(name, {})
+        self.setup_memory_index(name, partition=config.get("partition", None))
+
+    def get_index_options(self, name):
+        """
+        Reads the vector index settings from the bot's config.
+
+        `memory_index` is one of "hnsw" (default), "ivfflat" or "none". An HNSW
+        scan returns at most HNSW_MAX_EF_SEARCH (1000) rows, so with "hnsw" a
+        recall gets at most that many candidates whatever `memory_candidates` is.
+        """
+        config = self.bot_configs.get(name, {})
+        return {
+            "kind": str(config.get("memory_index", "hnsw")).lower(),
+            "m": int(config.get("memory_index_m", 16)),
+            "ef_construction": int(config.get("memory_index_ef_construction", 64)),
+            "lists": int(config.get("memory_index_lists", 100)),
+            "ef_search": int(config.get("memory_ef_search", 40)),
+            "probes": int(config.get("memory_probes", 10)),
+        }
+
+    def memory_index_name(self, name, kind, partition=None):
+        if partition is None:
+            suffix = "null"
+        else:
+            suffix = hashlib.md5(partition.encode("utf-8")).hexdigest()[:12]
+        return short_identifier(f"{self.memory_table(name)}_embedding_{kind}_{suffix}_idx", "memory_embedding_idx")
+
+    @metrics.timed("db.setup_memory_index")
+    def setup_memory_index(self, name, partition=None):
+        """
+        Creates the approximate nearest neighbour index on memory embeddings
+        as a partial index covering only the given partition, since every
+        recall is scoped to a single partition.
+
+        The index is built with CREATE INDEX CONCURRENTLY on a background
+        thread, so startup, recalls and inserts don't wait for it; recalls
+        scan the partition until it is ready. An ivfflat index is deferred
+        until the partition has enough rows to train its lists on. Deferred
+        or failed builds are retried by `ensure_memory_index` every
+        DEFERRED_INDEX_RETRY_INTERVAL seconds.
+        """
+        options = self.get_index_options(name)
+        kind = options["kind"]
+        if kind not in MEMORY_INDEX_OPS:
+            return
+        if kind == "hnsw":
+            params = sql.SQL("m = {}, ef_construction = {}").format(
+                sql.Literal(options["m"]), sql.Literal(options["ef_construction"])
+            )
+        else:
+            params = sql.SQL("lists = {}").format(sql.Literal(options["lists"]))
+            min_rows = options["lists"] * IVFFLAT_MIN_ROWS_PER_LIST
+            if self.count_memories(name, partition, limit=min_rows) < min_rows:
+                logger.debug(f"DB: Deferring ivfflat memory index for '{name}' (partition: {partition}) until it has {min_rows} rows")
+                self.deferred_indexes[(name, partition)] = time.monotonic()
+                return
+        if (name, partition) in self.building_indexes:
+            return
+        query = sql.SQL("CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} USING {} (embedding {}) WITH ({}) WHERE {}").format(
+            sql.Identifier(self.memory_index_name(name, kind, partition)),
+            sql.Identifier(self.memory_table(name)),
+            sql.SQL(kind),
+            sql.SQL(MEMORY_INDEX_OPS[kind]),
+            params,
+            partition_filter(partition),
+        )
+        self.building_indexes.add((name, partition))
+        threading.Thread(
+            target=self.build_memory_index,
+            args=(name, partition, self.memory_index_name(name, kind, partition), query),
+            name="memory-index",
+            daemon=True,
+        ).start()
+
+    @metrics.timed("db.build_memory_index")
+    def build_memory_index(self, name, partition, index, query):
+        try:
+            # CREATE INDEX CONCURRENTLY can't run inside a transaction
+            with psycopg.connect(self.bot_pools[name].conninfo, autocommit=True) as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        """
+                        SELECT indisvalid, EXISTS (
+                            SELECT 1 FROM pg_stat_progress_create_index WHERE index_relid = indexrelid
+                        )
+                        FROM pg_index WHERE indexrelid = to_regclass(quote_ident(%s));
+                        """,
+                        (index,),
+                    )
+                    row = cur.fetchone()
+                    if row is not None and not row[0]:
+                        if row[1]:
+                            # another process is building it, check again later
+                            self.deferred_indexes[(name, partition)] = time.monotonic()
+                            return
+                        # left behind by an interrupted concurrent build
+                        cur.execute(sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {};").format(sql.Identifier(index)))
+                    if row is None or not row[0]:
+                        logger.info(f"DB: Building memory index for '{name}' (partition: {partition})...")
+                        try:
+                            cur.execute(query)
+                        except psycopg.errors.UniqueViolation:
+                            # IF NOT EXISTS isn't safe against another process creating
+                            # the same index at the same time
+                            logger.debug("DB: Memory index was created concurrently")
+                        logger.info(f"DB: Built memory index for '{name}' (partition: {partition})")
+            self.indexed_partitions.setdefault(name, set()).add(partition)
+            self.deferred_indexes.pop((name, partition), None)
+        except Exception as e:
+            logger.error(f"DB: Could not build memory index for '{name}' (partition: {partition}): {e}")
+            self.deferred_indexes[(name, partition)] = time.monotonic()
+        finally:
+            self.building_indexes.discard((name, partition))
+
+    def count_memories(self, name, partition=None, limit=None):
+        """
+        Counts the memories in a partition, stopping at `limit` if given.
+        """
+        query = sql.SQL("SELECT count(*) FROM (SELECT 1 FROM {} WHERE {} LIMIT {}) AS memories;").format(
+            sql.Identifier(self.memory_table(name)),
+            partition_filter(partition),
+            sql.SQL("ALL") if limit is None else sql.Literal(limit),
+        )
+        with self.bot_pools[name].connection() as conn:
+            return conn.execute(query).fetchone()[0]
+
+    def ensure_memory_index(self, name, partition):
+        """
+        Starts building the partition's index if it has none yet, without waiting for it.
+        """
+        if partition in self.indexed_partitions.get(name, set()) or (name, partition) in self.building_indexes:
+            return
+        deferred_at = self.deferred_indexes.get((name, partition))
+        if deferred_at is not None and time.monotonic() - deferred_at < DEFERRED_INDEX_RETRY_INTERVAL:
+            return
+        with self.index_lock:
+            if partition not in self.indexed_partitions.get(name, set()):
+                self.setup_memory_index(name, partition=partition)
 
+    @metrics.timed("db.get_bot_configs")
     def get_bot_configs(self):
         with self.config_pool.connection() as conn:
             with conn.cursor() as cur:
@@ -61,9 +467,59 @@ class DB:
         configs = {}
         for result in results:
             configs[result[1]] = result[2]
-        self.bot_configs = configs
-        return configs
+        self.update_bot_configs(configs)
+        return self.bot_configs
 
+    def update_bot_config(self, name, config):
+        """
+        Updates (or, given None, removes) a single bot's cached config.
+        """
+        with self.config_lock:
+            configs = dict(self.bot_configs)
+            if config is None:
+                configs.pop(name, None)
+            else:
+                configs[name] = config
+            self.update_bot_configs(configs, changed=[name])
+
+    def update_bot_configs(self, configs, changed=None):
+        """
+        Replaces the cached configs with read-only snapshots and rebuilds the
+        channel routing table. Bumps the version of the `changed` bots (all of
+        them by default) so that they know to reload their settings.
+        """
+        snapshots = {name: MappingProxyType(dict(config or {})) for name, config in configs.items()}
+        channel_routes = {}
+        wildcard_bots = []
+        for name, config in snapshots.items():
+            channel_ids = parse_channel_ids(config.get("channel_ids", None))
+            if channel_ids is None:
+                wildcard_bots.append(name)
+                continue
+            for channel_id in channel_ids:
+                channel_routes.setdefault(channel_id, []).append(name)
+        # keep bots in config order, as they were before routing existed
+        order = {name: index for index, name in enumerate(snapshots)}
+        for channel_id, names in channel_routes.items():
+            channel_routes[channel_id] = sorted(names + wildcard_bots, key=order.get)
+        with self.config_lock:
+            self.bot_configs = snapshots
+            self.channel_routes = channel_routes
+            self.wildcard_bots = wildcard_bots
+            self.config_version += 1
+            for name in snapshots if changed is None else changed:
+                self.bot_config_versions[name] = self.config_version
+
+    def get_config_version(self, name):
+        return self.bot_config_versions.get(name, 0)
+
+    def get_channel_bots(self, channel_id):
+        """
+        Returns the names of the bots serving a channel.
+        """
+        return self.channel_routes.get(channel_id, self.wildcard_bots)
+
+    @metrics.timed("db.set_config")
     def set_config(self, name, config):
         config = json.dumps(config, default=str)
         with self.config_pool.connection() as conn:
@@ -75,7 +531,9 @@ class DB:
                     (config, name),
                 )
             conn.commit()
+        self.update_bot_config(name, json.loads(config))
 
+    @metrics.timed("db.insert_config")
     def insert_config(self, name, config):
         config = json.dumps(config, default=str)
         with self.config_pool.connection() as conn:
@@ -86,44 +544,414 @@ class DB:
                     (name, config),
                 )
             conn.commit()
+        self.update_bot_config(name, json.loads(config))
+
+    def setup_short_term_memory_table(self):
+        with self.config_pool.connection() as conn:
+            with conn.cursor() as cur:
+                logger.debug("DB: Setting up short term memory table...")
+                cur.execute(
+                    """
+                        CREATE TABLE IF NOT EXISTS short_term_memory (
+                            bot varchar(255),
+                            channel varchar(255),
+                            data JSONB,
+                            updated_at timestamp DEFAULT now(),
+                            PRIMARY KEY (bot, channel)
+                        );
+                    """
+                )
+            conn.commit()
 
-    def insert_memory(self, name, embedding, metadata, partition=None):
+    @metrics.timed("db.load_short_term_memory")
+    def load_short_term_memory(self, name, channel):
+        with self.config_pool.connection() as conn:
+            with conn.cursor() as cur:
+                logger.debug(f"DB: Loading short term memory for {name} ({channel})...")
+                cur.execute(
+                    "SELECT data FROM short_term_memory WHERE bot = %s AND channel = %s;",
+                    (name, channel),
+                )
+                result = cur.fetchone()
+        return result[0] if result else None
+
+    @metrics.timed("db.save_short_term_memories")
+    def save_short_term_memories(self, records):
+        """
+        Upserts short-term memories in one transaction.
+
+        Parameters:
+        records: A list of (bot name, channel, data) tuples.
+        """
+        with self.config_pool.connection() as conn:
+            with conn.cursor() as cur:
+                logger.debug(f"DB: Saving {len(records)} short term memories...")
+                cur.executemany(
+                    """
+                        INSERT INTO short_term_memory (bot, channel, data, updated_at)
+                        VALUES (%s, %s, %s, now())
+                        ON CONFLICT (bot, channel) DO UPDATE SET data = EXCLUDED.data, updated_at = EXCLUDED.updated_at;
+                    """,
+                    [(name, channel, dump_metadata(data)) for name, channel, data in records],
+                )
+            conn.commit()
+
+    @metrics.timed("db.insert_memories")
+    def insert_memories(self, name, memories):
+        """
+        Writes many memories in one transaction using a binary COPY.
+
+        Parameters:
+        name: The bot's name.
+        memories: A list of dicts with "embedding", "metadata" and "partition" keys.
+        """
+        if not memories:
+            return
         pool = self.bot_pools[name]
-        metadata = json.dumps(metadata, default=str)
         with pool.connection() as conn:
             register_vector(conn)
             with conn.cursor() as cur:
-                logger.debug(f"DB: Inserting memory for {name}...")
-                cur.execute(
-                    f"INSERT INTO memory (embedding, metadata, partition) VALUES (%s, %s, %s);",
-                    (embedding, metadata, partition),
-                )
+                logger.debug(f"DB: Inserting {len(memories)} memories for {name}...")
+                self.copy_memories(cur, name, memories)
             conn.commit()
 
+    def copy_memories(self, cur, name, memories):
+        """
+        Writes memories with a binary COPY on the given cursor, without committing.
+        `memories` may be any iterable of dicts, so it can be streamed.
+        """
+        with cur.copy(
+            sql.SQL(
+                "COPY {} (embedding, metadata, partition, importance, created_at) FROM STDIN WITH (FORMAT BINARY);"
+            ).format(sql.Identifier(self.memory_table(name)))
+        ) as copy:
+            copy.set_types(["vector", "jsonb", "varchar", "float4", "timestamp"])
+            for memory in memories:
+                metadata = memory["metadata"]
+                copy.write_row(
+                    [
+                        np.asarray(memory["embedding"], dtype=np.float32),
+                        Jsonb(metadata, dumps=dump_metadata),
+                        memory.get("partition", None),
+                        metadata.get("importance", None),
+                        parse_timestamp(metadata.get("timestamp", None)),
+                    ]
+                )
+
+    def set_search_options(self, cur, options, n):
+        """
+        Sets the vector index's search options for the current transaction.
+        """
+        if options["kind"] == "hnsw":
+            # ef_search bounds how many rows an HNSW scan can return
+            ef_search = min(max(options["ef_search"], n), HNSW_MAX_EF_SEARCH)
+            cur.execute("SELECT set_config('hnsw.ef_search', %s, true);", (str(ef_search),))
+        elif options["kind"] == "ivfflat":
+            cur.execute("SELECT set_config('ivfflat.probes', %s, true);", (str(options["probes"]),))
+
+    @metrics.timed("db.recall_memory")
     def recall_memory(self, name, vector, n=100, partition=None):
         pool = self.bot_pools[name]
+        options = self.get_index_options(name)
+        self.ensure_memory_index(name, partition)
         with pool.connection() as conn:
             register_vector(conn)
             with conn.cursor() as cur:
                 logger.debug(f"DB: Recalling memory for {name}...")
+                self.set_search_options(cur, options, n)
                 cur.execute(
-                    f"""
-                    SELECT
-                        id,
-                        embedding,
-                        metadata,
-                        1 - (embedding <-> CAST(%s AS vector)) AS score,
-                        partition
-                    FROM memory
-                    WHERE partition = %s
-                    ORDER BY embedding <-> CAST(%s AS vector) LIMIT %s;
-                """,
-                    (vector, partition, vector, n),
+                    sql.SQL(
+                        """
+                        SELECT
+                            id,
+                            metadata,
+                            embedding <-> CAST(%s AS vector) AS distance,
+                            partition
+                        FROM {}
+                        WHERE {}
+                        ORDER BY distance LIMIT %s;
+                        """
+                    ).format(sql.Identifier(self.memory_table(name)), partition_filter(partition)),
+                    (vector, n),
                 )
                 rows = cur.fetchall()
         message_response_pairs = []
         for row in rows:
             message_response_pairs.append(
-                {"id": row[0], "embedding": row[1], "metadata": row[2], "score": row[3], "partition": row[4]}
+                {"id": row[0], "metadata": row[1], "score": 1 - row[2], "partition": row[3]}
             )
         return message_response_pairs
+
+    @metrics.timed("db.recall_ranked_memory")
+    def recall_ranked_memory(self, name, vector, n=100, partition=None, candidates=1000, weights=(1 / 3, 1 / 3, 1 / 3), now=None):
+        """
+        Recalls memories ranked by the combined recency/importance/similarity
+        score, computed inside Postgres over the `candidates` nearest rows.
+        Mirrors the scoring in `Memory.search`.
+        """
+        pool = self.bot_pools[name]
+        options = self.get_index_options(name)
+        self.ensure_memory_index(name, partition)
+        recency_weight, importance_weight, similarity_weight = weights
+        params = {
+            "vector": vector,
+            "candidates": candidates,
+            "now": now or datetime.now(),
+            "recency_weight": recency_weight,
+            "importance_weight": importance_weight,
+            "similarity_weight": similarity_weight,
+            "n": n,
+        }
+        with pool.connection() as conn:
+            register_vector(conn)
+            with conn.cursor() as cur:
+                logger.debug(f"DB: Recalling ranked memory for {name}...")
+                self.set_search_options(cur, options, candidates)
+                cur.execute(
+                    sql.SQL(
+                        """
+                        WITH candidates AS (
+                            SELECT
+                                id,
+                                metadata,
+                                partition,
+                                importance,
+                                created_at,
+                                COALESCE(metadata->>'insight', '') <> '' AS is_insight,
+                                embedding <-> CAST(%(vector)s AS vector) AS distance
+                            FROM {}
+                            WHERE {}
+                            ORDER BY distance LIMIT %(candidates)s
+                        ), features AS (
+                            SELECT
+                                *,
+                                exp(-0.99 * least(floor(extract(epoch FROM (%(now)s::timestamp - created_at)) / 86400), 700))::float8 AS recency,
+                                1 - distance AS similarity
+                            FROM candidates
+                        ), scaled AS (
+                            SELECT
+                                *,
+                                (recency - min(recency) OVER ()) / (max(recency) OVER () - min(recency) OVER () + 1e-8) AS recency_scaled,
+                                (importance - min(importance) OVER kind) / (max(importance) OVER kind - min(importance) OVER kind + 1e-8) AS importance_scaled,
+                                (similarity - min(similarity) OVER ()) / (max(similarity) OVER () - min(similarity) OVER () + 1e-8) AS similarity_scaled
+                            FROM features
+                            WINDOW kind AS (PARTITION BY is_insight)
+                        )
+                        SELECT
+                            id,
+                            metadata,
+                            similarity,
+                            COALESCE(
+                                %(recency_weight)s * recency_scaled
+                                + %(importance_weight)s * importance_scaled
+                                + %(similarity_weight)s * similarity_scaled,
+                                0
+                            ) AS score,
+                            partition
+                        FROM scaled
+                        ORDER BY score DESC LIMIT %(n)s;
+                        """
+                    ).format(sql.Identifier(self.memory_table(name)), partition_filter(partition)),
+                    params,
+                )
+                rows = cur.fetchall()
+        memories = []
+        for row in rows:
+            memories.append(
+                {"id": row[0], "metadata": row[1], "similarity": row[2], "score": row[3], "partition": row[4]}
+            )
+        return memories
+
+    @metrics.timed("db.compact_memory")
+    def compact_memory(self, name, partition=None, similarity_threshold=0.97, min_score=0.0, half_life_days=30.0, now=None, window_size=1000, neighbours=10):
+        """
+        Merges near-duplicate memories in the partition and evicts low-value
+        ones (see `MemoryBackend.compact_memory`), then vacuums the table and
+        rebuilds the partition's vector index.
+
+        The whole partition is never loaded: only memories inserted since the
+        last run are compared, `window_size` at a time, each against its
+        `neighbours` nearest memories found through the vector index. Each
+        window is committed with its progress, so an interrupted run resumes
+        where it stopped. Eviction is a single DELETE on the decayed importance.
+
+        "bytes_reclaimed" is how much the partition's vector index shrank when
+        it was rebuilt; "index_bytes_before" and "index_bytes_after" are its sizes.
+        """
+        pool = self.bot_pools[name]
+        table = sql.Identifier(self.memory_table(name))
+        options = self.get_index_options(name)
+        self.ensure_memory_index(name, partition)
+        progress_key = (self.memory_table(name), json.dumps(partition))
+        with pool.connection() as conn:
+            with conn.cursor() as cur:
+                logger.debug(f"DB: Compacting memory for {name} (partition: {partition})...")
+                cur.execute(sql.SQL("SELECT count(*) FROM {} WHERE {};").format(table, partition_filter(partition)))
+                rows = cur.fetchone()[0]
+        report = {"rows": rows, "merged": 0, "evicted": 0, "remaining": rows, "bytes_reclaimed": 0}
+
+        while True:
+            with pool.connection() as conn:
+                register_vector(conn)
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "SELECT last_id FROM memory_compaction WHERE memory_table = %s AND partition_key = %s;",
+                        progress_key,
+                    )
+                    row = cur.fetchone()
+                    last_id = row[0] if row else 0
+                    cur.execute(
+                        sql.SQL("SELECT id FROM {} WHERE {} AND id > %s ORDER BY id LIMIT %s;").format(
+                            table, partition_filter(partition)
+                        ),
+                        (last_id, window_size),
+                    )
+                    window = [row[0] for row in cur.fetchall()]
+                    if not window:
+                        break
+                    self.set_search_options(cur, options, neighbours)
+                    cur.execute(
+                        sql.SQL(
+                            """
+                            WITH recent AS (
+                                SELECT id, embedding FROM {table} WHERE {partition} AND id = ANY(%(window)s::bigint[])
+                            )
+                            SELECT id, embedding, importance, created_at, COALESCE(metadata->>'insight', '') <> ''
+                            FROM {table} WHERE {partition} AND id IN (
+                                SELECT id FROM recent
+                                UNION
+                                SELECT neighbour.id FROM recent CROSS JOIN LATERAL (
+                                    SELECT id FROM {table} WHERE {partition}
+                                    ORDER BY embedding <-> recent.embedding LIMIT %(neighbours)s
+                                ) AS neighbour
+                            ) ORDER BY id;
+                            """
+                        ).format(table=table, partition=partition_filter(partition)),
+                        {"window": window, "neighbours": neighbours},
+                    )
+                    candidates = cur.fetchall()
+                    ids = np.array([row[0] for row in candidates], dtype=np.int64)
+                    updates, merged, _ = plan_compaction(
+                        np.stack([row[1] for row in candidates]),
+                        [row[2] or 0 for row in candidates],
+                        np.array([row[3] for row in candidates], dtype="datetime64[us]"),
+                        [row[4] for row in candidates],
+                        similarity_threshold=similarity_threshold,
+                    )
+                    if updates:
+                        cur.execute(
+                            sql.SQL(
+                                """
+                                UPDATE {} AS memory SET
+                                    importance = updated.importance,
+                                    metadata = memory.metadata || jsonb_build_object(
+                                        'importance', updated.importance,
+                                        'merged', COALESCE((memory.metadata->>'merged')::int, 0) + updated.merged
+                                    )
+                                FROM unnest(%s::bigint[], %s::float8[], %s::int[]) AS updated(id, importance, merged)
+                                WHERE memory.id = updated.id;
+                                """
+                            ).format(table),
+                            (
+                                [int(ids[i]) for i in updates],
+                                [importance for importance, _ in updates.values()],
+                                [merged_count for _, merged_count in updates.values()],
+                            ),
+                        )
+                    if merged.size:
+                        cur.execute(
+                            sql.SQL("DELETE FROM {} WHERE id = ANY(%s::bigint[]);").format(table),
+                            ([int(i) for i in ids[merged]],),
+                        )
+                    cur.execute(
+                        """
+                        INSERT INTO memory_compaction (memory_table, partition_key, last_id) VALUES (%s, %s, %s)
+                        ON CONFLICT (memory_table, partition_key) DO UPDATE SET last_id = EXCLUDED.last_id;
+                        """,
+                        (*progress_key, window[-1]),
+                    )
+                conn.commit()
+            report["merged"] += int(merged.size)
+            if len(window) < window_size:
+                break
+
+        if min_score > 0:
+            with pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        sql.SQL(
+                            """
+                            DELETE FROM {} WHERE {} AND COALESCE(importance, 0) * power(
+                                0.5,
+                                GREATEST(extract(epoch FROM %(now)s - COALESCE(created_at, %(now)s)), 0) / 86400 / %(half_life)s
+                            ) < %(min_score)s;
+                            """
+                        ).format(table, partition_filter(partition)),
+                        {"now": now or datetime.now(), "half_life": half_life_days, "min_score": min_score},
+                    )
+                    report["evicted"] = cur.rowcount
+                conn.commit()
+        report["remaining"] -= report["merged"] + report["evicted"]
+        if not report["merged"] and not report["evicted"]:
+            return report
+
+        # VACUUM and REINDEX CONCURRENTLY can't run inside a transaction
+        index = self.memory_index_name(name, options["kind"], partition)
+        with psycopg.connect(pool.conninfo, autocommit=True) as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql.SQL("VACUUM {};").format(table))
+                # an index still being built in the background is left alone
+                cur.execute(
+                    "SELECT pg_relation_size(indexrelid) FROM pg_index WHERE indexrelid = to_regclass(quote_ident(%s)) AND indisvalid;",
+                    (index,),
+                )
+                row = cur.fetchone()
+                index_bytes = row[0] if row else None
+                if index_bytes is not None:
+                    cur.execute(sql.SQL("REINDEX INDEX CONCURRENTLY {};").format(sql.Identifier(index)))
+                    cur.execute("SELECT pg_relation_size(quote_ident(%s)::regclass);", (index,))
+                    report["index_bytes_before"] = index_bytes
+                    report["index_bytes_after"] = cur.fetchone()[0]
+                    report["bytes_reclaimed"] = report["index_bytes_before"] - report["index_bytes_after"]
+        return report
+
+    @metrics.timed("db.migrate_memory")
+    def migrate_memory(self, name, batch_size=1000):
+        """
+        Copies a bot's memories from its own database into its partition of the
+        shared memory table. Only available in "shared" storage mode, and only
+        into an empty partition so that it can't duplicate rows. The copy runs
+        in a single transaction, so a failed migration leaves the partition
+        empty and can simply be retried.
+
+        Returns the number of memories copied.
+        """
+        if not self.shared:
+            raise ValueError("Memory can only be migrated in shared storage mode (DB_STORAGE_MODE=shared).")
+        if name not in self.bot_pools:
+            self.setup_bot_pool(name)
+        count = 0
+        with self.config_pool.connection() as conn, psycopg.connect(DB_URI + f"/{name}") as source:
+            register_vector(conn)
+            register_vector(source)
+            with conn.cursor() as cur, source.cursor(name="migrate_memory") as source_cur:
+                cur.execute(sql.SQL("SELECT EXISTS (SELECT 1 FROM {});").format(sql.Identifier(self.memory_table(name))))
+                if cur.fetchone()[0]:
+                    raise ValueError(f"Shared memory for {name} is not empty, refusing to migrate.")
+                logger.info(f"DB: Migrating memory for {name}...")
+                source_cur.execute("SELECT embedding, metadata, partition FROM memory ORDER BY id;")
+
+                def rows():
+                    nonlocal count
+                    while True:
+                        batch = source_cur.fetchmany(batch_size)
+                        if not batch:
+                            return
+                        count += len(batch)
+                        for embedding, metadata, partition in batch:
+                            yield {"embedding": embedding, "metadata": metadata, "partition": partition}
+
+                self.copy_memories(cur, name, rows())
+            conn.commit()
+        logger.info(f"DB: Migrated {count} memories for {name}.")
+        return count
@@ -0,0 +1,126 @@
+import time
+import sqlite3
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+
+from config import get_logger
+
+logger = get_logger(__name__)
+
+class EmbeddingCache:
+    """
+    Caches embeddings keyed by a hash of the model and text.
+
+    Recently used embeddings are kept in memory as packed float32 arrays, with
+    the least recently used evicted once `max_bytes` is exceeded. If `path` is
+    given, every embedding is also written to a SQLite file, which is checked
+    on an in-memory miss and survives restarts. Once the stored embeddings
+    exceed `max_disk_bytes`, the least recently used are deleted from the
+    file until it is back under 90% of the limit.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024, path=None, max_disk_bytes=1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_size = 0
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.disk = None
+        if path:
+            self.disk = sqlite3.connect(path, check_same_thread=False)
+            self.disk.execute("CREATE TABLE IF NOT EXISTS embedding (key TEXT PRIMARY KEY, vector BLOB);")
+            columns = [row[1] for row in self.disk.execute("PRAGMA table_info(embedding);")]
+            if "used_at" not in columns:
+                self.disk.execute("ALTER TABLE embedding ADD COLUMN used_at REAL DEFAULT 0;")
+            self.disk.execute("CREATE INDEX IF NOT EXISTS embedding_used_at_idx ON embedding (used_at);")
+            self.disk.commit()
+            self.disk_size = self.disk.execute("SELECT COALESCE(SUM(length(vector)), 0) FROM embedding;").fetchone()[0]
+            self.prune_disk()
+
+    @staticmethod
+    def key(text, model):
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def get(self, text, model):
+        key = self.key(text, model)
+        with self.lock:
+            vector = self.entries.get(key)
+            if vector is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.unpack(vector)
+            if self.disk is not None:
+                row = self.disk.execute("SELECT vector FROM embedding WHERE key = ?;", (key,)).fetchone()
+                if row is not None:
+                    self.disk_hits += 1
+                    self.disk.execute("UPDATE embedding SET used_at = ? WHERE key = ?;", (time.time(), key))
+                    self.disk.commit()
+                    self.remember(key, row[0])
+                    return self.unpack(row[0])
+            self.misses += 1
+        return None
+
+    def put(self, text, model, embedding):
+        key = self.key(text, model)
+        vector = array("f", embedding).tobytes()
+        with self.lock:
+            self.remember(key, vector)
+            if self.disk is not None:
+                row = self.disk.execute("SELECT length(vector) FROM embedding WHERE key = ?;", (key,)).fetchone()
+                self.disk.execute(
+                    "INSERT OR REPLACE INTO embedding (key, vector, used_at) VALUES (?, ?, ?);",
+                    (key, vector, time.time()),
+                )
+                self.disk.commit()
+                self.disk_size += len(vector) - (row[0] if row else 0)
+                self.prune_disk()
+
+    def prune_disk(self):
+        if self.disk_size <= self.max_disk_bytes:
+            return
+        target = self.disk_size - int(self.max_disk_bytes * 0.9)
+        keys = []
+        freed = 0
+        for key, size in self.disk.execute("SELECT key, length(vector) FROM embedding ORDER BY used_at;"):
+            if freed >= target:
+                break
+            keys.append((key,))
+            freed += size
+        self.disk.executemany("DELETE FROM embedding WHERE key = ?;", keys)
+        self.disk.commit()
+        self.disk_size -= freed
+        logger.debug(f"EmbeddingCache: Pruned {len(keys)} embeddings from disk")
+
+    def remember(self, key, vector):
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+        self.entries[key] = vector
+        self.size += len(vector)
+        while self.size > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    @staticmethod
+    def unpack(vector):
+        embedding = array("f")
+        embedding.frombytes(vector)
+        return embedding.tolist()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "disk_bytes": self.disk_size,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
@@ -1,17 +1,84 @@
 import json
 import re
+import time
+import asyncio
 from datetime import datetime
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import openai
-from config import OPENAI_API_KEY, get_logger
+from config import OPENAI_API_KEY, MEMORIZE_WORKERS, get_logger
 from memory import Memory
-from openai_tools import get_embedding, num_tokens_from_messages
+from reflection import reflection_scheduler
+from compaction import compaction_scheduler
+from pinning import PinFilter
+from response_cache import ResponseCache
+from metrics import metrics
+from short_term_memory import ShortTermMemory
+from openai_tools import embedding_batcher, aget_embedding, chat_completion, achat_completion, achat_completion_stream, get_summary, TokenBudget
 
 logger = get_logger(__name__)
 
 openai.api_key = OPENAI_API_KEY
 
+# interactions are memorized off the reply path, on a bounded pool shared by every bot
+memorize_executor = ThreadPoolExecutor(max_workers=MEMORIZE_WORKERS, thread_name_prefix="memorize")
+
+class Turn:
+    """
+    One message's trip through the pipeline, holding what earlier stages
+    computed so later ones can reuse it.
+
+    Attributes:
+    message: A string representing the user's message.
+    channel_id: The channel the message was sent in.
+    embedding: The message's embedding, once it has been resolved.
+    """
+    def __init__(self, message, channel_id=None):
+        self.message = message
+        self.channel_id = channel_id
+        self.embedding = None
+        self.embedding_future = None
+        self.embedding_task = None
+        self.cache_key = None
+
+    def start_embedding(self):
+        """
+        Submits the message to the embedding batcher without waiting for it.
+        """
+        start = time.perf_counter()
+        self.embedding_future = embedding_batcher.submit(self.message)
+        self.embedding_future.add_done_callback(
+            lambda _: metrics.observe("send_message.embedding", time.perf_counter() - start)
+        )
+
+    def get_embedding(self):
+        if self.embedding is None:
+            if self.embedding_future is None:
+                self.start_embedding()
+            self.embedding = self.embedding_future.result()
+        return self.embedding
+
+    def astart_embedding(self):
+        """
+        Starts embedding the message in a task on the running loop.
+        """
+        self.embedding_task = asyncio.create_task(self.embed())
+
+    @metrics.timed("send_message.embedding")
+    async def embed(self):
+        return await aget_embedding(self.message)
+
+    async def aget_embedding(self):
+        if self.embedding is None:
+            if self.embedding_task is None:
+                self.astart_embedding()
+            self.embedding = await self.embedding_task
+        return self.embedding
+
+# distinguishes "no memory backend given" from an explicit None
+DEFAULT_MEMORY_BACKEND = object()
+
 class ChatGPT:
     """
     A class to handle chat functionality with OpenAI's GPT-3 model.
@@ -19,18 +86,31 @@ class ChatGPT:
     Attributes:
     db: A database object to store and retrieve chat configurations.
     name: A string representing the name of the chatbot.
+    store: An optional ShortTermStore persisting each channel's short-term memory.
+    memory_backend: The MemoryBackend holding long-term memory, or None to
+        disable long-term memory. Defaults to the database, if one is configured.
     """
-    def __init__(self, db, name):
+    def __init__(self, db, name, store=None, memory_backend=DEFAULT_MEMORY_BACKEND):
         self.db = db
         self.name = name
+        self.store = store
+        if memory_backend is DEFAULT_MEMORY_BACKEND:
+            memory_backend = None if db.disabled else db
+        self.memory_backend = memory_backend
+        self.channels = {}
+        self.channels_lock = threading.Lock()
         self.load_config()
-        self.short_term_memory = []
-        self.pinned_message = None
+        self.background_tasks = set()
     
     def load_config(self):
         """
-        Loads the configuration for the chatbot from the database.
+        Loads the configuration for the chatbot from the database. Does nothing
+        if the configs haven't changed since the last load.
         """
+        config_version = self.db.get_config_version(self.name)
+        if getattr(self, "config_version", None) == config_version:
+            return
+        self.config_version = config_version
         self.config = self.db.bot_configs[self.name] if self.name in self.db.bot_configs else {}
         self.system_prompt = self.config.get("system_prompt", "You are a large language model with the ability to recall snippets from past conversations. You are incredibly helpful, friendly, engaging, and personable.")
         self.gpt_model = self.config.get("gpt_model", "gpt-3.5-turbo")
@@ -38,11 +118,55 @@ class ChatGPT:
         self.max_response_tokens = int(self.config.get("max_response_tokens", 490))
         self.short_term_memory_max_tokens = int(self.config.get("short_term_memory_max_tokens", 1500))
         self.partition = self.config.get("partition", None)
-        self.long_term_memory = Memory(db=self.db, name=self.name, partition=self.partition)
+        memory_options = {
+            "partition": self.partition,
+            "weights": (
+                float(self.config.get("memory_recency_weight", 1 / 3)),
+                float(self.config.get("memory_importance_weight", 1 / 3)),
+                float(self.config.get("memory_similarity_weight", 1 / 3)),
+            ),
+            "candidates": int(self.config.get("memory_candidates", 100)),
+            "ranking": self.config.get("memory_ranking", "python"),
+            "flush_size": int(self.config.get("memory_flush_size", 16)),
+            "flush_interval": float(self.config.get("memory_flush_interval", 5.0)),
+            "reflection_importance": float(self.config.get("reflection_importance_threshold", 2.0)),
+            "reflection_turns": int(self.config.get("reflection_turns", 8)),
+            "scoring": self.config.get("memory_scoring", "separate"),
+            "interaction_embedding": self.config.get("memory_interaction_embedding", "text"),
+            "compaction_interval": float(self.config.get("memory_compaction_interval", 0)),
+            "compaction_similarity": float(self.config.get("memory_compaction_similarity", 0.97)),
+            "compaction_min_score": float(self.config.get("memory_compaction_min_score", 0.0)),
+            "compaction_half_life": float(self.config.get("memory_compaction_half_life", 30.0)),
+        }
+        # Keep the same Memory (and its write buffer) while its options are unchanged
+        if memory_options != getattr(self, "memory_options", None):
+            if getattr(self, "long_term_memory", None):
+                self.long_term_memory.store_unscored()
+            self.long_term_memory = Memory(db=self.memory_backend, name=self.name, **memory_options)
+            self.memory_options = memory_options
+            if self.memory_backend is not None:
+                compaction_scheduler.register(self.long_term_memory)
+        response_cache_options = {
+            "max_entries": int(self.config.get("response_cache_size", 1000)),
+            "ttl": float(self.config.get("response_cache_ttl", 3600)),
+            "threshold": float(self.config.get("response_cache_threshold", 0.95)),
+        }
+        if not self.config.get("response_cache", False):
+            self.response_cache = None
+        elif response_cache_options != getattr(self, "response_cache_options", None) or getattr(self, "response_cache", None) is None:
+            self.response_cache = ResponseCache(**response_cache_options)
+        self.response_cache_options = response_cache_options
         self.clean_re_pattern = self.config.get("clean_re_pattern", None)
         self.disable_long_term_memory = self.config.get("disable_long_term_memory", True)
         self.disable_self_pinning = self.config.get("disable_self_pinning", True)
+        self.pin_filter = PinFilter(
+            mode=self.config.get("pinning_filter", "keywords"),
+            pattern=self.config.get("pinning_pattern", None),
+            threshold=float(self.config.get("pinning_similarity_threshold", 0.8)),
+        )
         self.max_short_term_memory = int(self.config.get("max_short_term_memory", 4))
+        self.enable_summarization = self.config.get("enable_summarization", False)
+        self.summary_max_tokens = int(self.config.get("summary_max_tokens", 256))
 
         self.token_capacity = 4096
         if "32k" in self.gpt_model:
@@ -52,23 +176,300 @@ class ChatGPT:
         elif "gpt-4" in self.gpt_model:
             self.token_capacity = 8192
         
-        if self.db.disabled:
+        if self.memory_backend is None:
             self.disable_long_term_memory = True
 
-    def send_message(self, message):
+    def get_short_term_memory(self, channel_id=None):
+        """
+        Returns a channel's short-term memory, loading it from the store the
+        first time the channel is used.
+
+        Parameters:
+        channel_id: The Discord channel ID, or None outside of Discord.
+        """
+        memory = self.channels.get(channel_id)
+        if memory is not None:
+            memory.set_model(self.gpt_model)
+            return memory
+        with self.channels_lock:
+            memory = self.channels.get(channel_id)
+            if memory is None:
+                data = self.store.load(self.name, channel_id) if self.store else None
+                data = data or {}
+                memory = ShortTermMemory(
+                    self.gpt_model,
+                    messages=data.get("messages", []),
+                    pinned_message=data.get("pinned_message", None),
+                    summary=data.get("summary", None),
+                    unsummarized=data.get("unsummarized", []),
+                )
+                self.channels[channel_id] = memory
+        return memory
+
+    def save_short_term_memory(self, channel_id=None):
+        """
+        Marks a channel's short-term memory to be written with the store's next flush.
+        """
+        if self.store:
+            self.store.mark_dirty(self.name, channel_id, self.get_short_term_memory(channel_id))
+
+    def clear_short_term_memory(self, channel_id=None):
+        memory = self.get_short_term_memory(channel_id)
+        memory.clear()
+        self.save_short_term_memory(channel_id)
+
+    def compress(self, memory, evicted, channel_id=None):
+        """
+        Folds messages trimmed from short-term memory into the channel's running
+        summary. The summary is written in a background thread, off the reply path.
+
+        Parameters:
+        memory: The channel's ShortTermMemory.
+        evicted: A list of messages trimmed from short-term memory.
+        channel_id: The channel the messages were sent in.
+        """
+        if not self.enable_summarization or not evicted:
+            return
+        if memory.queue_summary(evicted):
+            threading.Thread(target=self.summarize, args=(memory, channel_id)).start()
+
+    @metrics.timed("summarize")
+    def summarize(self, memory, channel_id=None):
+        """
+        Summarizes queued messages until none are left. If a summary fails,
+        its messages are queued again and retried once more are queued.
+
+        Parameters:
+        memory: The channel's ShortTermMemory.
+        channel_id: The channel the messages were sent in.
+        """
+        while True:
+            messages = memory.take_unsummarized()
+            if not messages:
+                return
+            try:
+                memory.summary = get_summary(memory.summary, messages, self.summary_max_tokens)
+                logger.debug(f"Updated summary: {memory.summary}")
+            except Exception as e:
+                logger.error(e)
+                memory.requeue_summary(messages)
+                self.save_short_term_memory(channel_id)
+                return
+            self.save_short_term_memory(channel_id)
+
+    def needs_embedding(self):
+        """
+        Whether the message's embedding is used before the completion.
+        """
+        return bool(
+            self.response_cache
+            or not self.disable_long_term_memory
+            or (not self.disable_self_pinning and self.pin_filter.mode == "embedding")
+        )
+
+    @metrics.timed("send_message")
+    def send_message(self, message, channel_id=None):
         """
         Constructs the request to OpenAI and sends it.
 
         Parameters:
         message: A string representing the user's message.
+        channel_id: The channel the message was sent in.
+
+        Returns:
+        A string representing the chatbot's response.
+        """
+        self.load_config()
+        turn = Turn(message, channel_id)
+        if self.needs_embedding():
+            # start embedding the message while the channel is loaded
+            turn.start_embedding()
+        with metrics.span("send_message.load_channel"):
+            memory = self.get_short_term_memory(channel_id)
+
+        if self.response_cache:
+            turn.cache_key = self.response_cache_key(memory)
+            cached = self.get_cached_response(turn.cache_key, turn.get_embedding())
+            if cached is not None:
+                return self.finish_response(message, cached, channel_id, turn.embedding)
+
+        if not self.disable_self_pinning:
+            embedding = turn.get_embedding() if self.pin_filter.mode == "embedding" else None
+            if self.pin_filter.is_candidate(message, embedding):
+                threading.Thread(
+                    target=self.handle_message_pinning, args=(message, channel_id, memory.pin_ticket())
+                ).start()
+
+        long_term_memory_messages = []
+        if not self.disable_long_term_memory:
+            embedding = turn.get_embedding()
+            with metrics.span("send_message.recall"):
+                long_term_memory_messages = self.long_term_memory.search(embedding)
+
+        with metrics.span("send_message.prompt"):
+            messages = self.build_messages(message, long_term_memory_messages, memory, channel_id)
+
+        # Send the request to OpenAI
+        logger.debug("OpenAI: Chat Completion (send_message)")
+        with metrics.span("send_message.completion"):
+            response = chat_completion(**self.completion_kwargs(messages))
+        self.cache_response(turn, response.choices[0].message.content)
+        return self.handle_response(message, response, channel_id, turn.embedding)
+
+    @metrics.timed("send_message")
+    async def asend_message(self, message, channel_id=None, on_delta=None):
+        """
+        Same as `send_message`, but uses the async OpenAI client so it can run
+        directly on the event loop. Database access is run in a worker thread.
+
+        The message's embedding and the long-term memory search start as soon
+        as the message arrives and run while the channel is loaded and the
+        short-term part of the prompt is assembled.
+
+        Parameters:
+        message: A string representing the user's message.
+        channel_id: The channel the message was sent in.
+        on_delta: An optional coroutine function. If given, the response is
+            streamed and it is awaited with the text received so far as each
+            piece arrives.
 
         Returns:
         A string representing the chatbot's response.
         """
         self.load_config()
+        turn = Turn(message, channel_id)
+        if self.needs_embedding():
+            turn.astart_embedding()
+        recall = None
+        if not self.disable_long_term_memory:
+            recall = asyncio.create_task(self.arecall(turn))
+
+        memory = self.channels.get(channel_id)
+        if memory is None:
+            with metrics.span("send_message.load_channel"):
+                memory = await asyncio.to_thread(self.get_short_term_memory, channel_id)
+
+        if self.response_cache:
+            turn.cache_key = self.response_cache_key(memory)
+            cached = self.get_cached_response(turn.cache_key, await turn.aget_embedding())
+            if cached is not None:
+                if recall is not None:
+                    recall.cancel()
+                if on_delta is not None:
+                    await on_delta(cached)
+                return self.finish_response(message, cached, channel_id, turn.embedding)
+
+        if not self.disable_self_pinning:
+            embedding = await turn.aget_embedding() if self.pin_filter.mode == "embedding" else None
+            if await self.pin_filter.ais_candidate(message, embedding):
+                self.run_in_background(
+                    self.ahandle_message_pinning(message, channel_id, memory.pin_ticket())
+                )
+
+        with metrics.span("send_message.prompt"):
+            messages, short_term_messages = self.build_short_term_messages(message, memory, channel_id)
+        long_term_memory_messages = await recall if recall is not None else []
+        with metrics.span("send_message.long_term_prompt"):
+            messages = self.add_long_term_messages(messages, short_term_messages, long_term_memory_messages)
+
+        if on_delta is not None:
+            logger.debug("OpenAI: Chat Completion (asend_message, streamed)")
+            response_message = ""
+            start = time.perf_counter()
+            with metrics.span("send_message.completion"):
+                async for content in achat_completion_stream(**self.completion_kwargs(messages)):
+                    if not response_message:
+                        metrics.observe("send_message.first_token", time.perf_counter() - start)
+                    response_message += content
+                    await on_delta(response_message)
+            self.cache_response(turn, response_message)
+            return self.finish_response(message, response_message, channel_id, turn.embedding)
+
+        logger.debug("OpenAI: Chat Completion (asend_message)")
+        with metrics.span("send_message.completion"):
+            response = await achat_completion(**self.completion_kwargs(messages))
+        self.cache_response(turn, response.choices[0].message.content)
+        return self.handle_response(message, response, channel_id, turn.embedding)
+
+    @metrics.timed("send_message.recall")
+    async def arecall(self, turn):
+        """
+        Searches long-term memory with the turn's message embedding.
+        """
+        embedding = await turn.aget_embedding()
+        return await asyncio.to_thread(self.long_term_memory.search, embedding)
 
-        # Construct the request to OpenAI
+    def response_cache_key(self, memory):
+        """
+        Returns the cache key for a reply in the channel of the given
+        ShortTermMemory. The channel's pinned message and summary are part of
+        the prompt, so replies are only reused while they are the same. The
+        bot's last reply in the channel is included too, so a follow-up such as
+        "yes" or "tell me more" only reuses a reply given after the same turn.
+        """
+        pinned_message = json.dumps(memory.pinned_message, sort_keys=True) if memory.pinned_message else ""
+        summary = memory.summary if self.enable_summarization and memory.summary else ""
+        last_reply = next(
+            (message["content"] for message in reversed(list(memory)) if message["role"] == "assistant"), ""
+        )
+        return ResponseCache.config_key(
+            self.system_prompt, self.gpt_model, self.temperature, pinned_message, summary, last_reply
+        )
+
+    def get_cached_response(self, key, embedding):
+        """
+        Returns a cached response to a similar message, or None.
+        """
+        return self.response_cache.get(key, embedding)
+
+    def cache_response(self, turn, response_message):
+        """
+        Caches the raw response under the key the turn was looked up with, if
+        the response cache is enabled.
+        """
+        if self.response_cache and turn.cache_key is not None and turn.embedding is not None:
+            self.response_cache.put(turn.cache_key, turn.embedding, response_message)
 
+    def run_in_background(self, coroutine):
+        """
+        Schedules a coroutine on the running loop, keeping a reference to the
+        task until it finishes.
+        """
+        task = asyncio.create_task(coroutine)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
+
+    def build_messages(self, message, long_term_memory_messages, memory, channel_id=None):
+        """
+        Assembles the prompt from the system prompt, pinned message, recalled
+        long-term memories and short-term memory.
+
+        Parameters:
+        message: A string representing the user's message.
+        long_term_memory_messages: A list of results from `Memory.search`.
+        memory: The channel's ShortTermMemory.
+        channel_id: The channel the message was sent in.
+
+        Returns:
+        A list of messages to send to OpenAI.
+        """
+        messages, short_term_messages = self.build_short_term_messages(message, memory, channel_id)
+        return self.add_long_term_messages(messages, short_term_messages, long_term_memory_messages)
+
+    def build_short_term_messages(self, message, memory, channel_id=None):
+        """
+        Assembles the parts of the prompt that don't depend on long-term memory.
+
+        Parameters:
+        message: A string representing the user's message.
+        memory: The channel's ShortTermMemory.
+        channel_id: The channel the message was sent in.
+
+        Returns:
+        A tuple of the leading system messages and the short-term messages,
+        newest first.
+        """
         # System Prompt
         system_prompt = self.system_prompt
         if self.config.get("include_username", False):
@@ -81,20 +482,16 @@ class ChatGPT:
         ]
 
         # Pinned Message
-        if self.pinned_message:
+        pinned_message = memory.pinned_message
+        if pinned_message:
             messages.append(
                 {
                     "role": "system",
                     "content": "You have determined the following message to be important enough to pin to your memory.  Place the greatest emphasis on this message and following any directives it provides.",
                 },
             )
-            logger.debug(f"Appending pinned message: {self.pinned_message}")
-            messages.append(self.pinned_message)
-        
-        if not self.disable_self_pinning:
-            threading.Thread(
-                target=self.handle_message_pinning, args=(message,)
-            ).start()
+            logger.debug(f"Appending pinned message: {pinned_message}")
+            messages.append(pinned_message)
 
         # Short Term Memory
         # Add short-term memory messages up to our token limit
@@ -105,96 +502,151 @@ class ChatGPT:
             },
             {"role": "user", "content": message},
         ]
-        for msg in reversed(self.short_term_memory):
-            if (
-                num_tokens_from_messages(short_term_messages + [msg], self.gpt_model)
-                <= self.short_term_memory_max_tokens
-            ):
+        short_term_budget = TokenBudget(
+            self.gpt_model, self.short_term_memory_max_tokens, short_term_messages
+        )
+        # The summary stands in for the turns trimmed before the ones below,
+        # so it is budgeted first and placed before them
+        summary_message = None
+        if self.enable_summarization and memory.summary:
+            summary_message = {
+                "role": "system",
+                "content": f"Summary of the earlier conversation: {memory.summary}",
+            }
+            if not short_term_budget.add([summary_message]):
+                summary_message = None
+        for msg, num_tokens in reversed(memory.items()):
+            if short_term_budget.reserve(num_tokens):
                 short_term_messages.append(msg)
             else:
                 break
+        if summary_message:
+            short_term_messages.append(summary_message)
         
-        if len(self.short_term_memory) > self.max_short_term_memory:
-            self.short_term_memory = self.short_term_memory[-self.max_short_term_memory:]
+        self.compress(memory, memory.trim(max_messages=self.max_short_term_memory), channel_id)
         
+        return messages, short_term_messages
+
+    def add_long_term_messages(self, messages, short_term_messages, long_term_memory_messages):
+        """
+        Adds recalled long-term memories to the prompt until the token limit is
+        reached, followed by the short-term messages.
+
+        Parameters:
+        messages: The leading system messages from `build_short_term_messages`.
+        short_term_messages: The short-term messages from `build_short_term_messages`.
+        long_term_memory_messages: A list of results from `Memory.search`.
+
+        Returns:
+        A list of messages to send to OpenAI.
+        """
         # Long Term Memory
-        if not self.disable_long_term_memory:
-            long_term_memory_messages = self.long_term_memory.search(get_embedding(message))
-
-            # Add long-term memory messages until the token limit is reached
-            token_limit = self.token_capacity - self.max_response_tokens
-            for msg in sorted(long_term_memory_messages, key=lambda x: x["timestamp"]):
-                if msg["insight"]:
-                    temp_msg = [
-                        {
-                            "role": "system",
-                            "content": f"You had the following insight on {msg['timestamp']}: {msg['insight']}",
-                        }
-                    ]
-                else:
-                    temp_msg = [
-                        {
-                            "role": "system",
-                            "content": f"This is a snippet from earlier on {msg['timestamp']}",
-                        },
-                        {"role": "user", "content": msg["message"]},
-                        {"role": "assistant", "content": msg["response"]},
-                    ]
-
-                if (
-                    num_tokens_from_messages(
-                        messages + short_term_messages + temp_msg, self.gpt_model
-                    )
-                    <= token_limit
-                ):
-                    messages.extend(temp_msg)
-                else:
-                    break
+        # Add long-term memory messages until the token limit is reached
+        token_limit = self.token_capacity - self.max_response_tokens
+        budget = TokenBudget(self.gpt_model, token_limit, messages + short_term_messages)
+        for msg in sorted(long_term_memory_messages, key=lambda x: x["timestamp"]):
+            if msg["insight"]:
+                temp_msg = [
+                    {
+                        "role": "system",
+                        "content": f"You had the following insight on {msg['timestamp']}: {msg['insight']}",
+                    }
+                ]
+            else:
+                temp_msg = [
+                    {
+                        "role": "system",
+                        "content": f"This is a snippet from earlier on {msg['timestamp']}",
+                    },
+                    {"role": "user", "content": msg["message"]},
+                    {"role": "assistant", "content": msg["response"]},
+                ]
+
+            if budget.add(temp_msg):
+                messages.extend(temp_msg)
+            else:
+                break
 
         # Add short-term memory messages to the end of the message list
         messages.extend(reversed(short_term_messages))
+        return messages
 
-        # Send the request to OpenAI
-        logger.debug("OpenAI: Chat Completion (send_message)")
-        response = openai.ChatCompletion.create(
-            model=self.gpt_model,
-            messages=messages,
-            temperature=self.temperature,
-            max_tokens=self.max_response_tokens,
-        )
-        response_message = response.choices[0].message.content
-        
+    def completion_kwargs(self, messages):
+        return {
+            "model": self.gpt_model,
+            "messages": messages,
+            "temperature": self.temperature,
+            "max_tokens": self.max_response_tokens,
+        }
+
+    def handle_response(self, message, response, channel_id=None, embedding=None):
+        """
+        Extracts and cleans the response message, then memorizes the interaction
+        in the background.
+
+        Parameters:
+        message: A string representing the user's message.
+        response: The chat completion response from OpenAI.
+        channel_id: The channel the message was sent in.
+        embedding: The message's embedding, if it was computed.
+
+        Returns:
+        A string representing the chatbot's response.
+        """
+        return self.finish_response(message, response.choices[0].message.content, channel_id, embedding)
+
+    def finish_response(self, message, response_message, channel_id=None, embedding=None):
+        """
+        Cleans the response message and memorizes the interaction in the background.
+
+        Parameters:
+        message: A string representing the user's message.
+        response_message: A string representing the chatbot's raw response.
+        channel_id: The channel the message was sent in.
+        embedding: The message's embedding, if it was computed.
+
+        Returns:
+        A string representing the chatbot's response.
+        """
         # If configured, clean the response message
         if self.clean_re_pattern:
             response_message = self.clean_message(response_message, re_pattern=self.clean_re_pattern)
 
-        threading.Thread(
-            target=self.memorize, args=(message, response_message)
-        ).start()
+        future = memorize_executor.submit(self.memorize, message, response_message, channel_id, embedding)
+        future.add_done_callback(self.log_memorize_error)
 
         return response_message
 
-    def memorize(self, message, response_content):
+    def log_memorize_error(self, future):
+        if future.exception() is not None:
+            logger.error(f"Error memorizing interaction: {future.exception()}")
+
+    @metrics.timed("memorize")
+    def memorize(self, message, response_content, channel_id=None, embedding=None):
         """
         Stores the user's message and the bot's response in the short-term memory.
 
         Parameters:
         message: A string representing the user's message.
         response_content: A string representing the chatbot's response.
+        channel_id: The channel the message was sent in.
+        embedding: The message's embedding, if it was computed.
         """
-        self.short_term_memory.append({"role": "user", "content": message})
-        self.short_term_memory.append(
-            {"role": "assistant", "content": response_content}
-        )
-        while (
-            num_tokens_from_messages(self.short_term_memory, self.gpt_model)
-            > self.short_term_memory_max_tokens
-        ):
-            self.short_term_memory.pop(0)
+        memory = self.get_short_term_memory(channel_id)
+        turn = [
+            {"role": "user", "content": message},
+            {"role": "assistant", "content": response_content},
+        ]
+        memory.extend(turn)
+        evicted = memory.trim(max_tokens=self.short_term_memory_max_tokens)
+        self.save_short_term_memory(channel_id)
+        self.compress(memory, evicted, channel_id)
         
         if not self.disable_long_term_memory:
-            self.long_term_memory.upload_message_response_pair(message, response_content)
-            self.long_term_memory.reflect(self.short_term_memory)
+            importance = self.long_term_memory.upload_message_response_pair(
+                message, response_content, message_embedding=embedding
+            )
+            reflection_scheduler.observe(self.long_term_memory, turn, importance)
     
     def clean_message(self, response_message, re_pattern):
         """
@@ -225,12 +677,44 @@ class ChatGPT:
             response = self.send_message(message)
             print(f"Chatbot: {response}")
     
-    def handle_message_pinning(self, message):
+    def handle_message_pinning(self, message, channel_id=None, ticket=None):
         """
         Handles the pinning of important messages.
 
         Parameters:
         message: A string representing the user's message.
+        channel_id: The channel the message was sent in.
+        ticket: The channel's pin ticket taken when the message was received.
+        """
+        logger.debug("OpenAI: Chat Completion (handle_message_pinning)")
+        with metrics.span("pinning"):
+            response = chat_completion(**self.pinning_kwargs(message, channel_id))
+        self.apply_pinning(response, channel_id, ticket)
+
+    async def ahandle_message_pinning(self, message, channel_id=None, ticket=None):
+        """
+        Same as `handle_message_pinning`, but uses the async OpenAI client.
+
+        Parameters:
+        message: A string representing the user's message.
+        channel_id: The channel the message was sent in.
+        ticket: The channel's pin ticket taken when the message was received.
+        """
+        logger.debug("OpenAI: Chat Completion (ahandle_message_pinning)")
+        try:
+            with metrics.span("pinning"):
+                response = await achat_completion(**self.pinning_kwargs(message, channel_id))
+            self.apply_pinning(response, channel_id, ticket)
+        except Exception as e:
+            logger.error(e)
+
+    def pinning_kwargs(self, message, channel_id=None):
+        """
+        Builds the function calling request asking GPT whether to pin the message.
+
+        Parameters:
+        message: A string representing the user's message.
+        channel_id: The channel the message was sent in.
         """
         # ask gpt if we should pin the message
         functions = [
@@ -261,7 +745,7 @@ class ChatGPT:
             },
             {
                 "role": "system",
-                "content": str(self.pinned_message),
+                "content": str(self.get_short_term_memory(channel_id).pinned_message),
             },
             {
                 "role": "system",
@@ -272,13 +756,22 @@ class ChatGPT:
                 "content": message,
             },
         ]
-        logger.debug("OpenAI: Chat Completion (handle_message_pinning)")
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo-0613",
-            messages=messages,
-            functions=functions,
-            function_call="auto",  # auto is default, but we'll be explicit
-        )
+        return {
+            "model": "gpt-3.5-turbo-0613",
+            "messages": messages,
+            "functions": functions,
+            "function_call": "auto",  # auto is default, but we'll be explicit
+        }
+
+    def apply_pinning(self, response, channel_id=None, ticket=None):
+        """
+        Calls `pin_message` if GPT decided to pin or unpin a message.
+
+        Parameters:
+        response: The chat completion response from OpenAI.
+        channel_id: The channel the message was sent in.
+        ticket: The channel's pin ticket taken when the message was received.
+        """
         response_message = response["choices"][0]["message"]
 
         if response_message.get("function_call"):
@@ -288,20 +781,28 @@ class ChatGPT:
             function_name = response_message["function_call"]["name"]
             fuction_to_call = available_functions[function_name]
             function_args = json.loads(response_message["function_call"]["arguments"])
-            fuction_to_call(**function_args)
+            fuction_to_call(**function_args, channel_id=channel_id, ticket=ticket)
     
-    def pin_message(self, message):
+    def pin_message(self, message, channel_id=None, ticket=None):
         """
         Pins a message to the bot's memory.
 
         Parameters:
         message: A string representing the user's message.
+        channel_id: The channel to pin the message in.
+        ticket: The pin ticket of the decision, if it came from GPT. Decisions
+            older than the last applied one are ignored.
         """
+        memory = self.get_short_term_memory(channel_id)
         if message:
             logger.debug(f"Storing pinned message: {message}")
-            self.pinned_message = {"role": "system", "content": str(message)}
+            pinned_message = {"role": "system", "content": str(message)}
         else:
-            self.pinned_message = None
+            pinned_message = None
+        if not memory.pin(pinned_message, ticket):
+            logger.debug("Discarding outdated pin decision")
+            return
+        self.save_short_term_memory(channel_id)
 
 pin_message_schema = {
     "type": "object",
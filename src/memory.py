@@ -1,129 +1,335 @@
+import atexit
+import weakref
+import threading
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future
 
-from openai_tools import get_embedding, get_importance_of_interaction, get_insights
+from openai_tools import embedding_batcher, get_embeddings, get_importance_of_interaction, get_insights, get_scored_insights
 from config import get_logger
+from metrics import metrics
 import numpy as np
 
 logger = get_logger(__name__)
 
+def min_max_scale(values, epsilon=1e-8):
+    if values.size == 0:
+        return values
+    return (values - values.min()) / (values.max() - values.min() + epsilon)
+
+# The most interactions rated by one structured reflection; older ones
+# waiting beyond that are stored with the default importance
+MAX_SCORED_INTERACTIONS = 10
+
+# The most memories kept buffered while writes are failing; the oldest are
+# dropped beyond that
+MAX_BUFFERED_MEMORIES = 1000
+
+# Memories with unflushed writes, flushed on exit
+_buffered_memories = weakref.WeakSet()
+
+@atexit.register
+def flush_all():
+    for memory in list(_buffered_memories):
+        memory.store_unscored()
+        memory.flush()
+
+def combine_embeddings(*embeddings):
+    """
+    Combines embeddings into one normalized vector.
+    """
+    vector = np.sum(np.asarray(embeddings, dtype=np.float32), axis=0)
+    return (vector / (np.linalg.norm(vector) or 1.0)).tolist()
+
+def embed_interaction(message, response, message_embedding=None):
+    """
+    Returns a Future resolving to an interaction's embedding. Given the
+    message's embedding, only the response is embedded and the two are combined.
+    """
+    if message_embedding is None:
+        return embedding_batcher.submit(message + response)
+    future = Future()
+
+    def combine(response_future):
+        try:
+            future.set_result(combine_embeddings(message_embedding, response_future.result()))
+        except Exception as e:
+            future.set_exception(e)
+
+    embedding_batcher.submit(response).add_done_callback(combine)
+    return future
+
 class Memory:
-    def __init__(self, db, name, partition=None):
+    def __init__(self, db, name, partition=None, weights=(1 / 3, 1 / 3, 1 / 3), candidates=100, ranking="python", flush_size=16, flush_interval=5.0, reflection_importance=2.0, reflection_turns=8, scoring="separate", interaction_embedding="text", compaction_interval=0, compaction_similarity=0.97, compaction_min_score=0.0, compaction_half_life=30.0):
         self.db = db
         self.name = name
         self.partition = partition
+        # weights for (recency, importance, similarity) when re-ranking search results
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.candidates = candidates
+        # "python" re-ranks recalled rows here, "sql" has Postgres return them
+        # ranked (if the backend supports it)
+        self.ranking = ranking
+        # writes are buffered and flushed once `flush_size` rows are pending
+        # or `flush_interval` seconds after the first pending row
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.buffer_lock = threading.Lock()
+        self.flush_timer = None
+        # reflect once the turns since the last reflection add up to
+        # `reflection_importance` or number `reflection_turns`
+        self.reflection_importance = reflection_importance
+        self.reflection_turns = reflection_turns
+        # "separate" rates each interaction and insight with its own completion,
+        # "structured" rates them all with the reflection's single completion
+        self.scoring = scoring
+        # "text" embeds the message and response together, "combined" reuses
+        # the message's embedding and only embeds the response. The two give
+        # different vectors for the same interaction, so switching an existing
+        # partition to "combined" needs its interactions re-embedded
+        self.interaction_embedding = interaction_embedding
+        self.unscored = []
+        # every `compaction_interval` hours (0 disables), merge memories with
+        # a cosine similarity of at least `compaction_similarity` and evict
+        # those whose importance, halved every `compaction_half_life` days,
+        # is below `compaction_min_score`
+        self.compaction_interval = compaction_interval
+        self.compaction_similarity = compaction_similarity
+        self.compaction_min_score = compaction_min_score
+        self.compaction_half_life = compaction_half_life
+
+    def store(self, embedding, metadata):
+        """
+        Queues a memory to be written with the next flush.
+        """
+        with self.buffer_lock:
+            self.buffer.append({"embedding": embedding, "metadata": metadata, "partition": self.partition})
+            _buffered_memories.add(self)
+            if len(self.buffer) < self.flush_size:
+                if self.flush_timer is None:
+                    self.flush_timer = threading.Timer(self.flush_interval, self.flush)
+                    self.flush_timer.daemon = True
+                    self.flush_timer.start()
+                return
+        self.flush()
+
+    @metrics.timed("memory.flush")
+    def flush(self):
+        """
+        Writes all buffered memories in a single bulk insert. If the insert
+        fails, they are put back in the buffer and retried after `flush_interval`.
+        """
+        with self.buffer_lock:
+            memories, self.buffer = self.buffer, []
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+        if memories:
+            try:
+                self.db.insert_memories(name=self.name, memories=memories)
+            except Exception as e:
+                logger.error(f"Memory: Failed to write {len(memories)} memories for {self.name}: {e}")
+                self.requeue(memories)
 
-    def upload_message_response_pair(self, message, response):
+    def requeue(self, memories):
+        """
+        Puts memories from a failed flush back ahead of any buffered since,
+        keeping at most MAX_BUFFERED_MEMORIES, and schedules another flush.
+        """
+        with self.buffer_lock:
+            self.buffer[:0] = memories
+            dropped = len(self.buffer) - MAX_BUFFERED_MEMORIES
+            if dropped > 0:
+                del self.buffer[:dropped]
+                logger.warning(f"Memory: Buffer full, dropped {dropped} memories for {self.name}")
+            _buffered_memories.add(self)
+            if self.flush_timer is None:
+                self.flush_timer = threading.Timer(self.flush_interval, self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+
+    def upload_message_response_pair(self, message, response, message_embedding=None):
+        """
+        Stores an interaction and returns its importance. With structured scoring
+        the interaction is held until the next reflection rates it, and None is returned.
+        """
+        if self.interaction_embedding != "combined":
+            message_embedding = None
+        embedding = embed_interaction(message, response, message_embedding)
+        if self.scoring == "structured":
+            with self.buffer_lock:
+                self.unscored.append((message, response, embedding, datetime.now()))
+                _buffered_memories.add(self)
+            return None
         importance = get_importance_of_interaction(message, response)
-        embedding = get_embedding(message + response)
-        metadata = {
-            "message": message,
-            "response": response,
-            "importance": importance,
-            "timestamp": datetime.now(),
-        }
-        self.db.insert_memory(name=self.name, embedding=embedding, metadata=metadata, partition=self.partition)
+        self.store_interaction(message, response, embedding, importance, datetime.now())
+        return importance
 
-    def insert_insight(self, insight):
-        embedding = get_embedding(insight["content"])
+    def insert_insight(self, insight, embedding=None):
+        if embedding is None:
+            embedding = embedding_batcher.embed(insight["content"])
         metadata = {
             "insight": insight["content"],
             "importance": insight["importance"],
             "timestamp": datetime.now(),
         }
-        self.db.insert_memory(name=self.name, embedding=embedding, metadata=metadata, partition=self.partition)
+        self.store(embedding, metadata)
+
+    def store_interaction(self, message, response, embedding, importance, timestamp):
+        metadata = {
+            "message": message,
+            "response": response,
+            "importance": importance,
+            "timestamp": timestamp,
+        }
+        self.store(embedding.result(), metadata)
+
+    def store_unscored(self, importance=0.3, unscored=None):
+        """
+        Stores interactions still waiting to be rated (or the given ones) with a default importance.
+        """
+        if unscored is None:
+            with self.buffer_lock:
+                unscored, self.unscored = self.unscored, []
+        for message, response, embedding, timestamp in unscored:
+            try:
+                self.store_interaction(message, response, embedding, importance, timestamp)
+            except Exception as e:
+                logger.error(f"Memory: Failed to store interaction for {self.name}: {e}")
 
+    @metrics.timed("reflect")
     def reflect(self, messages):
+        if self.scoring == "structured":
+            return self.reflect_structured(messages)
         insights = get_insights(messages)
-        futures = []
-        with ThreadPoolExecutor() as executor:
-            for insight in insights:
-                futures.append(executor.submit(self.insert_insight, insight))
-        for future in futures:
-            future.result()
+        if not insights:
+            return
+        embeddings = get_embeddings([insight["content"] for insight in insights])
+        for insight, embedding in zip(insights, embeddings):
+            self.insert_insight(insight, embedding)
+
+    def reflect_structured(self, messages):
+        """
+        Reflects on the messages and rates the resulting insights and the
+        newest `MAX_SCORED_INTERACTIONS` interactions waiting to be stored with
+        a single completion. Interactions that can't be rated are stored with
+        the default importance, so a request that keeps failing (e.g. for
+        being too long) doesn't hold them back indefinitely.
+        """
+        with self.buffer_lock:
+            unscored, self.unscored = self.unscored, []
+        overflow, unscored = unscored[:-MAX_SCORED_INTERACTIONS], unscored[-MAX_SCORED_INTERACTIONS:]
+        self.store_unscored(unscored=overflow)
+        try:
+            insights, importances = get_scored_insights(
+                messages, [(message, response) for message, response, _, _ in unscored]
+            )
+        except Exception:
+            self.store_unscored(unscored=unscored)
+            raise
+        for (message, response, embedding, timestamp), importance in zip(unscored, importances):
+            self.store_interaction(message, response, embedding, importance, timestamp)
+        if not insights:
+            return
+        embeddings = get_embeddings([insight["content"] for insight in insights])
+        for insight, embedding in zip(insights, embeddings):
+            self.insert_insight(insight, embedding)
+
+    @metrics.timed("compaction")
+    def compact(self):
+        """
+        Flushes buffered writes, then merges near-duplicate memories and evicts
+        low-value ones in this memory's partition.
 
+        Returns:
+        The backend's compaction report.
+        """
+        self.flush()
+        report = self.db.compact_memory(
+            self.name,
+            partition=self.partition,
+            similarity_threshold=self.compaction_similarity,
+            min_score=self.compaction_min_score,
+            half_life_days=self.compaction_half_life,
+        )
+        metrics.increment("memory_compacted_rows", report["merged"], reason="merged")
+        metrics.increment("memory_compacted_rows", report["evicted"], reason="evicted")
+        metrics.increment("memory_compacted_bytes", max(report["bytes_reclaimed"], 0))
+        logger.info(
+            f"Memory: Compacted {self.name} (partition: {self.partition}): merged {report['merged']} "
+            f"and evicted {report['evicted']} of {report['rows']} rows, reclaimed {report['bytes_reclaimed']} bytes"
+        )
+        return report
+
+    @metrics.timed("memory.search")
     def search(self, vector, n=100):
+        if self.ranking == "sql" and self.db.supports_ranking:
+            return self.search_ranked(vector, n=n)
+
         message_response_pairs = self.db.recall_memory(
-            name=self.name, vector=vector, n=n, partition=self.partition
+            name=self.name, vector=vector, n=max(n, self.candidates), partition=self.partition
         )
-        results = [
+        if not message_response_pairs:
+            return []
+
+        metadata = [result["metadata"] for result in message_response_pairs]
+        timestamps = np.array([m["timestamp"] for m in metadata], dtype="datetime64[us]")
+        importance = np.array([m["importance"] for m in metadata], dtype=np.float64)
+        similarity = np.array([result["score"] for result in message_response_pairs], dtype=np.float64)
+        is_insight = np.array([bool(m.get("insight")) for m in metadata])
+
+        # Recency decays exponentially with whole days elapsed
+        now = np.datetime64(datetime.now(), "us")
+        days_since = (now - timestamps) // np.timedelta64(1, "D")
+        recency = np.exp(-0.99 * days_since)
+
+        # Importance is scaled separately for insights and interactions
+        importance_scaled = np.empty_like(importance)
+        importance_scaled[is_insight] = min_max_scale(importance[is_insight])
+        importance_scaled[~is_insight] = min_max_scale(importance[~is_insight])
+
+        scores = np.column_stack(
+            (min_max_scale(recency), importance_scaled, min_max_scale(similarity))
+        ) @ self.weights
+
+        # Select the top n by score, in descending order
+        if n < len(scores):
+            top = np.argpartition(-scores, n - 1)[:n]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+
+        return [
             {
-                "message": result["metadata"]["message"]
-                if "message" in result["metadata"]
-                else None,
-                "response": result["metadata"]["response"]
-                if "response" in result["metadata"]
-                else None,
-                "insight": result["metadata"]["insight"]
-                if "insight" in result["metadata"]
-                else None,
-                "timestamp": result["metadata"]["timestamp"],
-                "importance": result["metadata"]["importance"],
-                "similarity": result["score"],
+                "message": metadata[i].get("message"),
+                "response": metadata[i].get("response"),
+                "insight": metadata[i].get("insight"),
+                "timestamp": metadata[i]["timestamp"],
+                "importance": metadata[i]["importance"],
+                "similarity": message_response_pairs[i]["score"],
+                "score": float(scores[i]),
             }
-            for result in message_response_pairs
+            for i in top
         ]
 
-        if results:
-            # Compute the values for each dimension
-            days_since_values = []
-            importance_values = []
-            similarity_values = []
-            for result in results:
-                timestamp = datetime.strptime(
-                    result["timestamp"], "%Y-%m-%d %H:%M:%S.%f"
-                )
-                days_since = (datetime.now() - timestamp).days
-                days_since_values.append(np.exp(-0.99 * days_since))
-                importance_values.append(result["importance"])
-                similarity_values.append(result["similarity"])
-
-            # Calculate the min and max values for each dimension
-            min_days_since, max_days_since = min(days_since_values), max(
-                days_since_values
-            )
-            min_similarity, max_similarity = min(similarity_values), max(
-                similarity_values
-            )
-            # Calculate the min and max values for importance separately for insights and non-insights
-            min_importance_insight, max_importance_insight = min(
-                x["importance"] for x in results if x["insight"]
-            ), max(x["importance"] for x in results if x["insight"])
-
-            min_importance_no_insight, max_importance_no_insight = min(
-                x["importance"] for x in results if not x["insight"]
-            ), max(x["importance"] for x in results if not x["insight"])
-
-            # Apply min-max scaling and compute the scaled score
-            epsilon = 1e-8
-            for i, result in enumerate(results):
-                days_since_scaled = (days_since_values[i] - min_days_since) / (
-                    max_days_since - min_days_since + epsilon
-                )
-                similarity_scaled = (similarity_values[i] - min_similarity) / (
-                    max_similarity - min_similarity + epsilon
-                )
-
-                # Scale importance based on whether it was an insight or not
-                if result["insight"]:
-                    importance_scaled = (
-                        importance_values[i] - min_importance_insight
-                    ) / (max_importance_insight - min_importance_insight + epsilon)
-                else:
-                    importance_scaled = (
-                        importance_values[i] - min_importance_no_insight
-                    ) / (
-                        max_importance_no_insight - min_importance_no_insight + epsilon
-                    )
-
-                result["score"] = (
-                    1 / 3 * days_since_scaled
-                    + 1 / 3 * importance_scaled
-                    + 1 / 3 * similarity_scaled
-                )
-
-            # Sort the results based on the score in descending order
-            results.sort(key=lambda x: x["score"], reverse=True)
-
-        # Return the top n results
-        return results[:n]
+    def search_ranked(self, vector, n=100):
+        memories = self.db.recall_ranked_memory(
+            name=self.name,
+            vector=vector,
+            n=n,
+            partition=self.partition,
+            candidates=max(n, self.candidates),
+            weights=tuple(float(weight) for weight in self.weights),
+        )
+        return [
+            {
+                "message": memory["metadata"].get("message"),
+                "response": memory["metadata"].get("response"),
+                "insight": memory["metadata"].get("insight"),
+                "timestamp": memory["metadata"]["timestamp"],
+                "importance": memory["metadata"]["importance"],
+                "similarity": memory["similarity"],
+                "score": memory["score"],
+            }
+            for memory in memories
+        ]
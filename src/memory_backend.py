@@ -0,0 +1,384 @@
+import os
+import json
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+import numpy as np
+
+from config import MEMORY_BACKEND, LOCAL_MEMORY_PATH, LOCAL_MEMORY_DTYPE, get_logger
+from metrics import metrics
+
+logger = get_logger(__name__)
+
+def dump_metadata(metadata):
+    return json.dumps(metadata, default=str)
+
+def plan_compaction(vectors, importance, timestamps, is_insight, similarity_threshold=0.97, min_score=0.0, half_life_days=30.0, now=None, block_size=1024):
+    """
+    Decides which memories to merge and which to evict.
+
+    Memories are visited newest first, and each one that hasn't been merged
+    yet absorbs every older memory of the same kind (insight or interaction)
+    whose embedding has a cosine similarity of at least `similarity_threshold`
+    to it. The newest memory of each group is kept, with the group's highest
+    importance. A kept memory is then evicted if its importance, halved every
+    `half_life_days` since it was stored, is below `min_score`.
+
+    Parameters:
+    vectors: An (n, dimensions) array of embeddings.
+    importance: The n importances.
+    timestamps: The n timestamps, as datetime64.
+    is_insight: n booleans, whether each memory is an insight.
+
+    Returns:
+    A tuple of (updates, merged, evicted): updates maps the index of each kept
+    memory that absorbed others to (importance, number of memories merged
+    into it), and merged and evicted are arrays of the indices to delete.
+    """
+    n = len(vectors)
+    if n == 0:
+        return {}, np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    importance = np.asarray(importance, dtype=np.float64)
+    timestamps = np.asarray(timestamps, dtype="datetime64[us]")
+    is_insight = np.asarray(is_insight, dtype=bool)
+
+    # index of the memory each one was merged into, or its own index if kept
+    leaders = np.arange(n)
+    for kind in (False, True):
+        # newest first
+        order = np.flatnonzero(is_insight == kind)
+        order = order[np.argsort(timestamps[order], kind="stable")[::-1]]
+        ordered = vectors[order]
+        # position in `order` of each memory's leader
+        leader = np.full(len(order), -1, dtype=np.int64)
+        for start in range(0, len(order), block_size):
+            # only later (older) memories can be merged into this block
+            similarities = ordered[start:start + block_size] @ ordered[start:].T
+            for row, similarity in enumerate(similarities):
+                i = start + row
+                if leader[i] >= 0:
+                    continue
+                leader[i] = i
+                members = np.flatnonzero((similarity[row + 1:] >= similarity_threshold) & (leader[i + 1:] < 0)) + i + 1
+                leader[members] = i
+        leaders[order] = order[leader]
+    merged_mask = leaders != np.arange(n)
+    merged = np.flatnonzero(merged_mask)
+    group_importance = importance.copy()
+    np.maximum.at(group_importance, leaders, importance)
+    group_size = np.bincount(leaders, minlength=n)
+
+    evicted_mask = np.zeros(n, dtype=bool)
+    if min_score > 0:
+        now = np.datetime64(now or datetime.now(), "us")
+        age_days = (now - timestamps) / np.timedelta64(1, "D")
+        score = group_importance * 0.5 ** (np.maximum(age_days, 0) / half_life_days)
+        evicted_mask = ~merged_mask & (score < min_score)
+    evicted = np.flatnonzero(evicted_mask)
+    updates = {
+        int(i): (float(group_importance[i]), int(group_size[i] - 1))
+        for i in np.flatnonzero((group_size > 1) & ~evicted_mask)
+    }
+    return updates, merged, evicted
+
+class MemoryBackend(ABC):
+    """
+    Where long-term memories are written and recalled from. `DB` implements
+    it with pgvector, `LocalMemoryStore` in process.
+
+    `recall_memory` returns a list of {"id", "metadata", "score", "partition"}
+    dicts for the `n` nearest memories in the partition, nearest first.
+    Backends that can also rank memories by the combined recency, importance
+    and similarity score set `supports_ranking` and implement `recall_ranked_memory`.
+    """
+    supports_ranking = False
+
+    def insert_memory(self, name, embedding, metadata, partition=None):
+        self.insert_memories(name, [{"embedding": embedding, "metadata": metadata, "partition": partition}])
+
+    @abstractmethod
+    def insert_memories(self, name, memories):
+        """
+        Writes a list of dicts with "embedding", "metadata" and "partition" keys.
+        """
+
+    @abstractmethod
+    def recall_memory(self, name, vector, n=100, partition=None):
+        """
+        Returns the `n` nearest memories in the partition, nearest first.
+        """
+
+    @abstractmethod
+    def compact_memory(self, name, partition=None, similarity_threshold=0.97, min_score=0.0, half_life_days=30.0, now=None):
+        """
+        Merges near-duplicate memories in the partition and evicts low-value
+        ones, as decided by `plan_compaction`.
+
+        Returns:
+        A dict with the number of "rows" before compaction, how many were
+        "merged" and "evicted", the "remaining" rows, and the storage
+        "bytes_reclaimed".
+        """
+
+def metadata_columns(metadata):
+    """
+    Returns the (importance, timestamp, is_insight) arrays `plan_compaction` needs.
+    """
+    importance = np.array([m.get("importance") or 0 for m in metadata], dtype=np.float64)
+    timestamps = np.array([m["timestamp"] for m in metadata], dtype="datetime64[us]")
+    is_insight = np.array([bool(m.get("insight")) for m in metadata])
+    return importance, timestamps, is_insight
+
+class LocalMemoryCollection:
+    """
+    One bot's memories, stored under `directory`.
+
+    Embeddings are appended as normalized rows to `vectors.bin`, which is read
+    through a memory map, and their metadata is kept in the `metadata.sqlite`
+    sidecar keyed by row number. A row only counts once its metadata is
+    committed, so a crash between the two writes leaves an unreferenced tail
+    that is truncated on the next open.
+
+    Compaction writes the surviving rows to `vectors.bin.compact`, renumbers
+    the metadata and records the pending swap in one transaction, then
+    replaces `vectors.bin`. An interrupted swap is finished on the next open,
+    and an uncommitted one is discarded.
+    """
+    def __init__(self, directory, dimensions=1536, dtype="float32"):
+        os.makedirs(directory, exist_ok=True)
+        self.dimensions = dimensions
+        self.dtype = np.dtype(dtype)
+        self.row_bytes = dimensions * self.dtype.itemsize
+        self.vectors_path = os.path.join(directory, "vectors.bin")
+        self.compacted_path = self.vectors_path + ".compact"
+        self.metadata_path = os.path.join(directory, "metadata.sqlite")
+        self.metadata = sqlite3.connect(self.metadata_path, check_same_thread=False)
+        self.metadata.execute(
+            "CREATE TABLE IF NOT EXISTS memory (id INTEGER PRIMARY KEY, partition TEXT, metadata TEXT);"
+        )
+        self.metadata.execute("CREATE TABLE IF NOT EXISTS compaction (pending INTEGER);")
+        self.metadata.commit()
+        self.lock = threading.Lock()
+        self.compaction_lock = threading.Lock()
+        # bumped whenever compaction renumbers rows
+        self.generation = 0
+        self.matrix = None
+        self.finish_compaction()
+        self.load_rows()
+
+    def finish_compaction(self):
+        pending = self.metadata.execute("SELECT COUNT(*) FROM compaction;").fetchone()[0]
+        if os.path.exists(self.compacted_path):
+            if pending:
+                os.replace(self.compacted_path, self.vectors_path)
+            else:
+                os.remove(self.compacted_path)
+        if pending:
+            self.metadata.execute("DELETE FROM compaction;")
+            self.metadata.commit()
+
+    def load_rows(self):
+        rows = self.metadata.execute("SELECT id, partition FROM memory ORDER BY id;").fetchall()
+        self.count = len(rows)
+        # partition -> row ids, so filtering doesn't scan every row's partition
+        self.partition_rows = {}
+        self.add_partition_rows(0, [partition for _, partition in rows])
+        with open(self.vectors_path, "ab") as f:
+            f.truncate(self.count * self.row_bytes)
+        self.matrix = None
+
+    def add_partition_rows(self, start, partitions):
+        new_rows = {}
+        for i, partition in enumerate(partitions, start):
+            new_rows.setdefault(partition, []).append(i)
+        for partition, ids in new_rows.items():
+            self.partition_rows[partition] = np.concatenate(
+                (self.partition_rows.get(partition, np.empty(0, dtype=np.int64)), np.asarray(ids, dtype=np.int64))
+            )
+
+    def insert(self, memories):
+        vectors = np.asarray([memory["embedding"] for memory in memories], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = (vectors / np.where(norms == 0, 1, norms)).astype(self.dtype)
+        with self.lock:
+            ids = range(self.count, self.count + len(memories))
+            with open(self.vectors_path, "ab") as f:
+                f.write(vectors.tobytes())
+            self.metadata.executemany(
+                "INSERT INTO memory (id, partition, metadata) VALUES (?, ?, ?);",
+                [
+                    (i, memory.get("partition"), dump_metadata(memory["metadata"]))
+                    for i, memory in zip(ids, memories)
+                ],
+            )
+            self.metadata.commit()
+            self.add_partition_rows(self.count, [memory.get("partition") for memory in memories])
+            self.count += len(memories)
+
+    def get_matrix(self):
+        # remap once rows have been appended since the last search
+        if self.matrix is None or len(self.matrix) != self.count:
+            if self.count == 0:
+                return np.empty((0, self.dimensions), dtype=self.dtype)
+            self.matrix = np.memmap(self.vectors_path, dtype=self.dtype, mode="r", shape=(self.count, self.dimensions))
+        return self.matrix
+
+    def search(self, vector, n=100, partition=None):
+        query = np.asarray(vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        with self.lock:
+            matrix = self.get_matrix()
+            candidates = self.partition_rows.get(partition)
+            generation = self.generation
+        if candidates is None or candidates.size == 0:
+            return []
+        query = query.astype(self.dtype)
+        if candidates.size == len(matrix):
+            similarities = matrix @ query
+        elif candidates.size < len(matrix) // 2:
+            similarities = matrix[candidates] @ query
+        else:
+            similarities = (matrix @ query)[candidates]
+        similarities = similarities.astype(np.float32)
+        if n < candidates.size:
+            top = np.argpartition(-similarities, n - 1)[:n]
+        else:
+            top = np.arange(candidates.size)
+        top = top[np.argsort(-similarities[top], kind="stable")]
+        ids = [int(i) for i in candidates[top]]
+
+        with self.lock:
+            if self.generation != generation:
+                # compacted since the rows were scored, so the ids have moved
+                return self.search(vector, n=n, partition=partition)
+            rows = self.metadata.execute(
+                f"SELECT id, metadata FROM memory WHERE id IN ({','.join('?' * len(ids))});", ids
+            ).fetchall()
+        metadata = {row[0]: json.loads(row[1]) for row in rows}
+        # match the pgvector backend's score of 1 - L2 distance between unit vectors
+        distances = np.sqrt(np.maximum(0, 2 - 2 * similarities[top]))
+        return [
+            {"id": i, "metadata": metadata[i], "score": float(1 - distance), "partition": partition}
+            for i, distance in zip(ids, distances)
+        ]
+
+    def size(self):
+        return sum(
+            os.path.getsize(path) for path in (self.vectors_path, self.metadata_path) if os.path.exists(path)
+        )
+
+    def compact(self, partition=None, **options):
+        """
+        Compacts one partition, see `MemoryBackend.compact_memory`. Rows are
+        planned from a snapshot, so inserts can continue meanwhile; only the
+        rewrite holds the lock.
+        """
+        with self.compaction_lock:
+            with self.lock:
+                ids = self.partition_rows.get(partition, np.empty(0, dtype=np.int64))
+                matrix = self.get_matrix()
+                rows = self.metadata.execute(
+                    "SELECT id, metadata FROM memory WHERE partition IS ? ORDER BY id;", (partition,)
+                ).fetchall()
+            report = {"rows": int(ids.size), "merged": 0, "evicted": 0, "remaining": int(ids.size), "bytes_reclaimed": 0}
+            if ids.size == 0:
+                return report
+            metadata = [json.loads(row[1]) for row in rows]
+            updates, merged, evicted = plan_compaction(
+                np.asarray(matrix[ids], dtype=np.float32), *metadata_columns(metadata), **options
+            )
+            report.update(merged=int(merged.size), evicted=int(evicted.size))
+            report["remaining"] -= report["merged"] + report["evicted"]
+            if not updates and not merged.size and not evicted.size:
+                return report
+
+            deleted = ids[np.concatenate((merged, evicted))]
+            updated = []
+            for i, (importance, merged_count) in updates.items():
+                metadata[i]["importance"] = importance
+                metadata[i]["merged"] = metadata[i].get("merged", 0) + merged_count
+                updated.append((dump_metadata(metadata[i]), int(ids[i])))
+
+            with self.lock:
+                size = self.size()
+                keep = np.ones(self.count, dtype=bool)
+                keep[deleted] = False
+                kept = np.flatnonzero(keep)
+                matrix = self.get_matrix()
+                with open(self.compacted_path, "wb") as f:
+                    for start in range(0, kept.size, 4096):
+                        f.write(np.ascontiguousarray(matrix[kept[start:start + 4096]]).tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+                with self.metadata:
+                    self.metadata.executemany("UPDATE memory SET metadata = ? WHERE id = ?;", updated)
+                    self.metadata.executemany("DELETE FROM memory WHERE id = ?;", [(int(i),) for i in deleted])
+                    # ascending, so a row never takes an id that is still in use
+                    self.metadata.executemany(
+                        "UPDATE memory SET id = ? WHERE id = ?;",
+                        [(new, int(old)) for new, old in enumerate(kept) if new != old],
+                    )
+                    self.metadata.execute("INSERT INTO compaction (pending) VALUES (1);")
+                self.matrix = matrix = None
+                self.finish_compaction()
+                self.metadata.execute("VACUUM;")
+                self.load_rows()
+                self.generation += 1
+                report["bytes_reclaimed"] = size - self.size()
+            return report
+
+class LocalMemoryStore(MemoryBackend):
+    """
+    Keeps long-term memory on local disk, one `LocalMemoryCollection` per bot
+    under `path`, and searches it in process with NumPy.
+    """
+    def __init__(self, path=LOCAL_MEMORY_PATH, dtype=LOCAL_MEMORY_DTYPE, dimensions=1536):
+        self.path = path
+        self.dtype = dtype
+        self.dimensions = dimensions
+        self.collections = {}
+        self.lock = threading.Lock()
+
+    def collection(self, name):
+        with self.lock:
+            if name not in self.collections:
+                logger.debug(f"LocalMemoryStore: Opening memory for {name}...")
+                self.collections[name] = LocalMemoryCollection(
+                    os.path.join(self.path, name), dimensions=self.dimensions, dtype=self.dtype
+                )
+            return self.collections[name]
+
+    @metrics.timed("local_memory.insert_memories")
+    def insert_memories(self, name, memories):
+        if not memories:
+            return
+        logger.debug(f"LocalMemoryStore: Inserting {len(memories)} memories for {name}...")
+        self.collection(name).insert(memories)
+
+    @metrics.timed("local_memory.recall_memory")
+    def recall_memory(self, name, vector, n=100, partition=None):
+        logger.debug(f"LocalMemoryStore: Recalling memory for {name}...")
+        return self.collection(name).search(vector, n=n, partition=partition)
+
+    @metrics.timed("local_memory.compact_memory")
+    def compact_memory(self, name, partition=None, **options):
+        logger.debug(f"LocalMemoryStore: Compacting memory for {name} (partition: {partition})...")
+        return self.collection(name).compact(partition, **options)
+
+def create_memory_backend(db):
+    """
+    Returns the backend selected by MEMORY_BACKEND: "postgres", "local", "none",
+    or "auto" (Postgres when a database is configured, otherwise local).
+    """
+    kind = MEMORY_BACKEND
+    if kind == "auto":
+        kind = "local" if db.disabled else "postgres"
+    if kind == "postgres" and not db.disabled:
+        return db
+    if kind == "local":
+        return LocalMemoryStore()
+    return None
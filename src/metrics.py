@@ -0,0 +1,212 @@
+import time
+import asyncio
+import functools
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+from aiohttp import web
+
+from config import get_logger
+
+logger = get_logger(__name__)
+
+PREFIX = "gpt_assistant_"
+
+# upper bounds, in seconds, of the stage latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(key):
+    if not key:
+        return ""
+    labels = ",".join(f'{name}="{escape(value)}"' for name, value in key)
+    return "{" + labels + "}"
+
+class Timing:
+    """
+    The latency distribution of one stage: Prometheus-style cumulative
+    buckets, plus the most recent `window` samples for percentiles.
+    """
+    def __init__(self, window=1024):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+        self.recent = deque(maxlen=window)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+        self.recent.append(seconds)
+
+    def percentiles(self, *qs):
+        if not self.recent:
+            return [0.0] * len(qs)
+        return [float(value) for value in np.percentile(np.fromiter(self.recent, dtype=np.float64), qs)]
+
+class Metrics:
+    """
+    Process-wide timings, counters and gauges.
+
+    Timings are recorded per stage with `span` or `timed`. Counters only go up
+    (`increment`). Gauges are read when the metrics are exported, from
+    callbacks registered with `register_gauge` by whatever owns the value
+    (queues, pools, caches).
+    """
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+        self.gauges = {}
+        self.help = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            timing = self.timings.get(stage)
+            if timing is None:
+                timing = self.timings[stage] = Timing()
+            timing.observe(seconds)
+
+    @contextmanager
+    def span(self, stage):
+        """
+        Times the body of a `with` block as `stage`, whether or not it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def timed(self, stage):
+        """
+        Decorator timing every call of a function or coroutine function as `stage`.
+        """
+        def decorator(func):
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.span(stage):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def increment(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def register_gauge(self, name, callback, description=None):
+        """
+        Registers a gauge read from `callback` at export time. The callback
+        returns a number, or a list of (labels dict, number) pairs.
+        """
+        with self.lock:
+            self.gauges[name] = callback
+            if description:
+                self.help[name] = description
+
+    def read_gauges(self):
+        with self.lock:
+            gauges = list(self.gauges.items())
+        values = {}
+        for name, callback in gauges:
+            try:
+                value = callback()
+            except Exception as e:
+                logger.error(f"Metrics: Could not read gauge {name}: {e}")
+                continue
+            if isinstance(value, (int, float)):
+                value = [({}, value)]
+            values[name] = [(label_key(labels), float(number)) for labels, number in value]
+        return values
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        with self.lock:
+            timings = {stage: (timing.count, timing.sum, list(timing.buckets)) for stage, timing in self.timings.items()}
+            counters = dict(self.counters)
+
+        name = f"{PREFIX}stage_seconds"
+        lines.append(f"# HELP {name} Time spent in each stage of the pipeline.")
+        lines.append(f"# TYPE {name} histogram")
+        for stage, (count, total, buckets) in sorted(timings.items()):
+            for bound, bucket in zip(BUCKETS, buckets):
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {bucket}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {count}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {total}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {count}')
+
+        for counter in sorted({counter for counter, _ in counters}):
+            name = f"{PREFIX}{counter}_total"
+            lines.append(f"# TYPE {name} counter")
+            for (other, key), value in sorted(counters.items()):
+                if other == counter:
+                    lines.append(f"{name}{format_labels(key)} {value}")
+
+        for gauge, values in sorted(self.read_gauges().items()):
+            name = f"{PREFIX}{gauge}"
+            if gauge in self.help:
+                lines.append(f"# HELP {name} {self.help[gauge]}")
+            lines.append(f"# TYPE {name} gauge")
+            for key, value in values:
+                lines.append(f"{name}{format_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Returns a short human readable report of the timings, counters and gauges.
+        """
+        lines = [f"{'stage':<32} {'count':>7} {'p50':>8} {'p95':>8} {'max':>8}"]
+        with self.lock:
+            for stage, timing in sorted(self.timings.items()):
+                p50, p95 = timing.percentiles(50, 95)
+                lines.append(
+                    f"{stage:<32} {timing.count:>7} {p50 * 1000:>6.0f}ms {p95 * 1000:>6.0f}ms {timing.max * 1000:>6.0f}ms"
+                )
+            counters = sorted(self.counters.items())
+        lines.append("")
+        for (name, key), value in counters:
+            lines.append(f"{name}{format_labels(key)}: {value:g}")
+        for name, values in sorted(self.read_gauges().items()):
+            for key, value in values:
+                lines.append(f"{name}{format_labels(key)}: {value:g}")
+        return "\n".join(lines)
+
+metrics = Metrics()
+
+async def start_metrics_server(host, port):
+    """
+    Serves `metrics.render()` at http://host:port/metrics. Returns the
+    aiohttp runner, to be cleaned up on shutdown.
+    """
+    async def handle(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics: Serving on http://{host}:{port}/metrics")
+    return runner
@@ -1,46 +1,240 @@
 import re
-from concurrent.futures import ThreadPoolExecutor
+import json
+import time
+import queue
+import random
+import asyncio
+import weakref
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
 
+import aiohttp
 import openai
-from config import OPENAI_API_KEY, get_logger
+from config import (
+    OPENAI_API_KEY,
+    OPENAI_MAX_CONNECTIONS,
+    OPENAI_CHAT_CONCURRENCY,
+    OPENAI_EMBEDDING_CONCURRENCY,
+    OPENAI_MAX_RETRIES,
+    EMBEDDING_CACHE_MAX_BYTES,
+    EMBEDDING_CACHE_PATH,
+    EMBEDDING_CACHE_MAX_DISK_BYTES,
+    EMBEDDING_BATCH_WINDOW_MS,
+    EMBEDDING_BATCH_MAX_SIZE,
+    get_logger,
+)
+from embedding_cache import EmbeddingCache
+from metrics import metrics
 import tiktoken
 
 logger = get_logger(__name__)
 
 openai.api_key = OPENAI_API_KEY
 
+EMBEDDING_MODEL = "text-embedding-ada-002"
 
-def get_embedding(text):
-    logger.debug(f"OpenAI: Getting embedding for text...")
-    return openai.Embedding.create(input=[text], model="text-embedding-ada-002")[
-        "data"
-    ][0]["embedding"]
+embedding_cache = EmbeddingCache(
+    max_bytes=EMBEDDING_CACHE_MAX_BYTES, path=EMBEDDING_CACHE_PATH, max_disk_bytes=EMBEDDING_CACHE_MAX_DISK_BYTES
+)
 
+metrics.register_gauge(
+    "embedding_cache",
+    lambda: [({"stat": key}, value) for key, value in embedding_cache.stats().items()],
+    "Embedding cache entries, size and hit counts.",
+)
 
-def get_importance_of_interaction(message, response):
-    logger.debug("OpenAI: Chat Completion (get_importance_of_interaction)")
-    importance_response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {
-                "role": "system",
-                "content": "You are a large language model. The following is a snippet of a conversation between a user and a chatbot.",
-            },
-            {"role": "user", "content": message},
-            {"role": "assistant", "content": response},
-            {
-                "role": "system",
-                "content": "Please rate the importance of remembering the above interaction on a scale from 1 to 10 where 1 is trivial and 10 is very important. Only respond with the number, do not add any commentary.",
-            },
-        ],
-        temperature=0,
-        n=1,
-        max_tokens=100,
-    )
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+)
 
-    numbers = re.findall(
-        r"\b(?:10|[1-9])\b", importance_response.choices[0].message.content
-    )
+
+class AsyncOpenAIClient:
+    """
+    Shares a single keep-alive aiohttp session between OpenAI requests made on
+    one event loop, limits how many requests run at once per endpoint, and
+    retries transient failures with jittered exponential backoff.
+    """
+    def __init__(self, max_retries=OPENAI_MAX_RETRIES, base_delay=0.5, max_delay=20):
+        self.session = None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.limits = {
+            "chat": asyncio.Semaphore(OPENAI_CHAT_CONCURRENCY),
+            "embedding": asyncio.Semaphore(OPENAI_EMBEDDING_CONCURRENCY),
+        }
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=OPENAI_MAX_CONNECTIONS, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def request(self, endpoint, create, **kwargs):
+        # openai reads the session from a context variable, so set it for the
+        # duration of this call only
+        token = openai.aiosession.set(self.get_session())
+        try:
+            attempt = 0
+            while True:
+                try:
+                    async with self.limits[endpoint]:
+                        with metrics.span(f"openai.{endpoint}"):
+                            response = await create(**kwargs)
+                    record_usage(endpoint, response)
+                    return response
+                except RETRYABLE_ERRORS as e:
+                    metrics.increment("openai_errors", endpoint=endpoint)
+                    if attempt >= self.max_retries:
+                        raise
+                    delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                    attempt += 1
+                    logger.warning(f"OpenAI: {endpoint} request failed ({e}), retry {attempt} in {delay:.2f}s")
+                    await asyncio.sleep(delay)
+        finally:
+            openai.aiosession.reset(token)
+
+    async def stream(self, endpoint, create, **kwargs):
+        """
+        Like `request`, but for streamed responses: yields the response chunks,
+        holding the endpoint's concurrency slot until the stream ends. Only
+        opening the stream is retried.
+        """
+        async with self.limits[endpoint]:
+            attempt = 0
+            while True:
+                try:
+                    with metrics.span(f"openai.{endpoint}.open_stream"):
+                        response = await self.open_stream(create, **kwargs)
+                    metrics.increment("openai_requests", endpoint=endpoint)
+                    break
+                except RETRYABLE_ERRORS as e:
+                    metrics.increment("openai_errors", endpoint=endpoint)
+                    if attempt >= self.max_retries:
+                        raise
+                    delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                    attempt += 1
+                    logger.warning(f"OpenAI: {endpoint} stream failed ({e}), retry {attempt} in {delay:.2f}s")
+                    await asyncio.sleep(delay)
+            async for chunk in response:
+                yield chunk
+
+    async def open_stream(self, create, **kwargs):
+        # the opened stream keeps its own reference to the session, so the
+        # context variable is only set while the request is made: a generator
+        # can be resumed or closed in another context, where resetting it fails
+        token = openai.aiosession.set(self.get_session())
+        try:
+            return await create(stream=True, **kwargs)
+        finally:
+            openai.aiosession.reset(token)
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+
+def record_usage(endpoint, response):
+    """
+    Counts a finished request and the tokens it reported using.
+    """
+    metrics.increment("openai_requests", endpoint=endpoint)
+    usage = response.get("usage") or {}
+    metrics.increment("openai_tokens", usage.get("prompt_tokens", 0), direction="sent")
+    metrics.increment("openai_tokens", usage.get("completion_tokens", 0), direction="received")
+
+
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client():
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncOpenAIClient()
+    return client
+
+
+async def close_async_client():
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
+
+
+async def achat_completion(**kwargs):
+    return await get_async_client().request("chat", openai.ChatCompletion.acreate, **kwargs)
+
+
+async def achat_completion_stream(**kwargs):
+    """
+    Streams a chat completion, yielding each piece of content as it arrives.
+    Streamed responses don't report usage, so tokens are counted locally
+    (each piece is one token).
+    """
+    metrics.increment("openai_tokens", num_tokens_from_messages(kwargs["messages"], kwargs["model"]), direction="sent")
+    async for chunk in get_async_client().stream("chat", openai.ChatCompletion.acreate, **kwargs):
+        content = chunk["choices"][0]["delta"].get("content")
+        if content:
+            metrics.increment("openai_tokens", direction="received")
+            yield content
+
+
+class OpenAIClient:
+    """
+    The blocking counterpart of `AsyncOpenAIClient`, shared by every thread:
+    limits how many requests run at once per endpoint and retries transient
+    failures with the same jittered exponential backoff.
+    """
+    def __init__(self, max_retries=OPENAI_MAX_RETRIES, base_delay=0.5, max_delay=20):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.limits = {
+            "chat": threading.BoundedSemaphore(OPENAI_CHAT_CONCURRENCY),
+            "embedding": threading.BoundedSemaphore(OPENAI_EMBEDDING_CONCURRENCY),
+        }
+
+    def request(self, endpoint, create, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                with self.limits[endpoint]:
+                    with metrics.span(f"openai.{endpoint}"):
+                        response = create(**kwargs)
+                record_usage(endpoint, response)
+                return response
+            except RETRYABLE_ERRORS as e:
+                metrics.increment("openai_errors", endpoint=endpoint)
+                if attempt >= self.max_retries:
+                    raise
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                attempt += 1
+                logger.warning(f"OpenAI: {endpoint} request failed ({e}), retry {attempt} in {delay:.2f}s")
+                time.sleep(delay)
+
+
+openai_client = OpenAIClient()
+
+
+def chat_completion(**kwargs):
+    return openai_client.request("chat", openai.ChatCompletion.create, **kwargs)
+
+
+def create_embedding(**kwargs):
+    return openai_client.request("embedding", openai.Embedding.create, **kwargs)
+
+
+async def aembedding(**kwargs):
+    return await get_async_client().request("embedding", openai.Embedding.acreate, **kwargs)
+
+
+def parse_importance(content):
+    numbers = re.findall(r"\b(?:10|[1-9])\b", content)
     if numbers:
         return int(numbers[0]) / 10
 
@@ -50,49 +244,289 @@ def get_importance_of_interaction(message, response):
     return 0.3
 
 
-def get_importance_of_insight(insight):
-    logger.debug("OpenAI: Chat Completion (get_importance_of_insight)")
-    importance_response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {
-                "role": "system",
-                "content": "You are a large language model. The following is an insight you gained from of a conversation with a user.",
+def interaction_importance_messages(message, response):
+    return [
+        {
+            "role": "system",
+            "content": "You are a large language model. The following is a snippet of a conversation between a user and a chatbot.",
+        },
+        {"role": "user", "content": message},
+        {"role": "assistant", "content": response},
+        {
+            "role": "system",
+            "content": "Please rate the importance of remembering the above interaction on a scale from 1 to 10 where 1 is trivial and 10 is very important. Only respond with the number, do not add any commentary.",
+        },
+    ]
+
+
+def insight_importance_messages(insight):
+    return [
+        {
+            "role": "system",
+            "content": "You are a large language model. The following is an insight you gained from of a conversation with a user.",
+        },
+        {"role": "assistant", "content": insight},
+        {
+            "role": "system",
+            "content": "Please rate the importance of remembering the above insight on a scale from 1 to 10 where 1 is trivial and 10 is very important. Only respond with the number, do not add any commentary.",
+        },
+    ]
+
+
+def insights_messages(messages):
+    return messages + [
+        {
+            "role": "system",
+            "content": 'Please list up to 5 high-level insights you can infer from the above conversation. You must respond in a list format with each insight surrounded by quotes, e.g. ["The user seems...", "The user likes...", "The user is...", ...]',
+        }
+    ]
+
+
+scored_insights_schema = {
+    "type": "object",
+    "properties": {
+        "insights": {
+            "type": "array",
+            "description": "Up to 5 high-level insights inferred from the conversation.",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "content": {
+                        "type": "string",
+                        "description": "The insight, e.g. \"The user likes...\"",
+                    },
+                    "importance": {
+                        "type": "integer",
+                        "description": "The importance of remembering the insight, from 1 (trivial) to 10 (very important).",
+                    },
+                },
+                "required": ["content", "importance"],
             },
-            {"role": "assistant", "content": insight},
+        },
+        "interaction_importance": {
+            "type": "array",
+            "description": "The importance of remembering each numbered interaction, in order, from 1 (trivial) to 10 (very important).",
+            "items": {"type": "integer"},
+        },
+    },
+    "required": ["insights"],
+}
+
+
+def truncate(text, max_chars):
+    return text if len(text) <= max_chars else text[:max_chars] + "..."
+
+
+def scored_insights_messages(messages, interactions=(), max_chars=400):
+    scored_messages = messages + [
+        {
+            "role": "system",
+            "content": "Please list up to 5 high-level insights you can infer from the above conversation, and rate the importance of remembering each one.",
+        }
+    ]
+    if interactions:
+        numbered = "\n".join(
+            f"{i}. user: {truncate(message, max_chars)}\nassistant: {truncate(response, max_chars)}"
+            for i, (message, response) in enumerate(interactions, 1)
+        )
+        scored_messages.append(
             {
                 "role": "system",
-                "content": "Please rate the importance of remembering the above insight on a scale from 1 to 10 where 1 is trivial and 10 is very important. Only respond with the number, do not add any commentary.",
-            },
+                "content": f"Also rate the importance of remembering each of the following interactions:\n{numbered}",
+            }
+        )
+    return scored_messages
+
+
+def scored_insights_kwargs(messages, interactions=()):
+    return {
+        "model": "gpt-3.5-turbo-0613",
+        "messages": scored_insights_messages(messages, interactions),
+        "functions": [
+            {
+                "name": "store_insights",
+                "description": "Stores insights and importance ratings in long-term memory.",
+                "parameters": scored_insights_schema,
+            }
         ],
+        "function_call": {"name": "store_insights"},
+        "temperature": 0,
+        "n": 1,
+        "max_tokens": 500,
+    }
+
+
+def scale_importance(value):
+    try:
+        return min(max(int(value), 1), 10) / 10
+    except (TypeError, ValueError):
+        return 0.3
+
+
+def parse_scored_insights(response, num_interactions=0):
+    """
+    Parses a `store_insights` function call into (insights, interaction importances).
+    Interactions the model did not rate default to 3 out of 10.
+    """
+    response_message = response["choices"][0]["message"]
+    try:
+        arguments = json.loads(response_message["function_call"]["arguments"])
+    except (KeyError, TypeError, ValueError):
+        logger.error("Error: Could not parse structured insights.")
+        arguments = {}
+    insights = [
+        {"content": str(insight["content"]), "importance": scale_importance(insight.get("importance"))}
+        for insight in arguments.get("insights", [])
+        if isinstance(insight, dict) and insight.get("content")
+    ]
+    importances = [scale_importance(value) for value in arguments.get("interaction_importance", [])]
+    importances = (importances + [0.3] * num_interactions)[:num_interactions]
+    return insights, importances
+
+
+def summary_messages(summary, messages):
+    conversation = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    return [
+        {
+            "role": "system",
+            "content": f"Summary of the conversation so far: {summary or 'None'}",
+        },
+        {
+            "role": "system",
+            "content": f"The conversation continued with the following messages:\n{conversation}",
+        },
+        {
+            "role": "system",
+            "content": "Please rewrite the summary so it also covers these messages. Keep any names, facts, preferences and open questions, and respond with only the summary.",
+        },
+    ]
+
+
+def get_embedding(text):
+    embedding = embedding_cache.get(text, EMBEDDING_MODEL)
+    if embedding is not None:
+        return embedding
+    logger.debug(f"OpenAI: Getting embedding for text...")
+    embedding = create_embedding(input=[text], model=EMBEDDING_MODEL)["data"][0]["embedding"]
+    embedding_cache.put(text, EMBEDDING_MODEL, embedding)
+    return embedding
+
+
+def get_embeddings(texts):
+    """
+    Embeds a list of texts, sending any that are not cached in a single request.
+    Returns the embeddings in the same order as the texts.
+    """
+    embeddings = [embedding_cache.get(text, EMBEDDING_MODEL) for text in texts]
+    missing = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+    if missing:
+        logger.debug(f"OpenAI: Getting embeddings for {len(missing)} texts...")
+        response = create_embedding(input=missing, model=EMBEDDING_MODEL)
+        fetched = {}
+        for item in response["data"]:
+            fetched[missing[item["index"]]] = item["embedding"]
+            embedding_cache.put(missing[item["index"]], EMBEDDING_MODEL, item["embedding"])
+        embeddings = [
+            fetched[text] if embedding is None else embedding
+            for text, embedding in zip(texts, embeddings)
+        ]
+    return embeddings
+
+
+class EmbeddingBatcher:
+    """
+    Coalesces embedding requests from concurrent callers.
+
+    Texts submitted within `window` seconds of the first pending one (up to
+    `max_batch` texts) are embedded together with one `get_embeddings` call on
+    a background thread.
+    """
+    def __init__(self, window=EMBEDDING_BATCH_WINDOW_MS / 1000, max_batch=EMBEDDING_BATCH_MAX_SIZE):
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, text):
+        """
+        Returns a Future resolving to the embedding of the text.
+        """
+        future = Future()
+        embedding = embedding_cache.get(text, EMBEDDING_MODEL)
+        if embedding is not None:
+            future.set_result(embedding)
+            return future
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="embedding-batcher", daemon=True)
+                self.thread.start()
+        self.pending.put((text, future))
+        return future
+
+    def embed(self, text):
+        return self.submit(text).result()
+
+    def run(self):
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                embeddings = get_embeddings([text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
+
+
+embedding_batcher = EmbeddingBatcher()
+
+metrics.register_gauge("embedding_batch_queue", lambda: embedding_batcher.pending.qsize(), "Texts waiting to be embedded.")
+
+
+# rates the insights of every reflection, instead of a pool per call
+insight_scoring_executor = ThreadPoolExecutor(max_workers=OPENAI_CHAT_CONCURRENCY, thread_name_prefix="insight-scoring")
+
+
+def get_importance_of_interaction(message, response):
+    logger.debug("OpenAI: Chat Completion (get_importance_of_interaction)")
+    importance_response = chat_completion(
+        model="gpt-3.5-turbo",
+        messages=interaction_importance_messages(message, response),
         temperature=0,
         n=1,
         max_tokens=100,
     )
+    return parse_importance(importance_response.choices[0].message.content)
 
-    numbers = re.findall(
-        r"\b(?:10|[1-9])\b", importance_response.choices[0].message.content
-    )
-    if numbers:
-        return int(numbers[0]) / 10
 
-    print(
-        "Error: Could not parse importance of interaction. Defaulting to 3 out of 10."
+def get_importance_of_insight(insight):
+    logger.debug("OpenAI: Chat Completion (get_importance_of_insight)")
+    importance_response = chat_completion(
+        model="gpt-3.5-turbo",
+        messages=insight_importance_messages(insight),
+        temperature=0,
+        n=1,
+        max_tokens=100,
     )
-    return 0.3
+    return parse_importance(importance_response.choices[0].message.content)
 
 
 def get_insights(messages):
     logger.debug("OpenAI: Chat Completion (get_insights)")
-    response = openai.ChatCompletion.create(
+    response = chat_completion(
         model="gpt-3.5-turbo",
-        messages=messages
-        + [
-            {
-                "role": "system",
-                "content": 'Please list up to 5 high-level insights you can infer from the above conversation. You must respond in a list format with each insight surrounded by quotes, e.g. ["The user seems...", "The user likes...", "The user is...", ...]',
-            }
-        ],
+        messages=insights_messages(messages),
         temperature=0.7,
         n=1,
         max_tokens=500,
@@ -101,27 +535,72 @@ def get_insights(messages):
     # Extract the insights from the string
     insights_list = re.findall(r'"(.*?)"', response.choices[0].message.content)
 
-    insights = []
-    futures = []
-    with ThreadPoolExecutor() as executor:
-        for insight in insights_list:
-            futures.append(executor.submit(get_importance_of_insight, insight))
+    importances = insight_scoring_executor.map(get_importance_of_insight, insights_list)
+    return [
+        {"content": insight, "importance": importance}
+        for insight, importance in zip(insights_list, importances)
+    ]
 
-        for insight, future in zip(insights_list, futures):
-            importance = future.result()
-            insights.append({"content": insight, "importance": importance})
 
-    return insights
+def get_scored_insights(messages, interactions=()):
+    """
+    Gets insights with their importance, and optionally the importance of each
+    interaction, from a single function calling completion.
+
+    Parameters:
+    messages: The conversation to reflect on.
+    interactions: A list of (message, response) pairs to rate.
+
+    Returns:
+    A tuple of (insights, interaction importances).
+    """
+    logger.debug("OpenAI: Chat Completion (get_scored_insights)")
+    response = chat_completion(**scored_insights_kwargs(messages, interactions))
+    return parse_scored_insights(response, len(interactions))
+
+
+def get_summary(summary, messages, max_tokens=256):
+    """
+    Folds messages into a running conversation summary.
+
+    Parameters:
+    summary: The current summary, or None.
+    messages: The messages to add to the summary.
+    max_tokens: The token budget for the new summary.
+
+    Returns:
+    The new summary.
+    """
+    logger.debug("OpenAI: Chat Completion (get_summary)")
+    response = chat_completion(
+        model="gpt-3.5-turbo",
+        messages=summary_messages(summary, messages),
+        temperature=0.3,
+        n=1,
+        max_tokens=max_tokens,
+    )
+    return response.choices[0].message.content.strip()
+
+
+async def aget_embedding(text):
+    # the cache's disk tier is SQLite, so it's read and written off the loop
+    embedding = await asyncio.to_thread(embedding_cache.get, text, EMBEDDING_MODEL)
+    if embedding is not None:
+        return embedding
+    logger.debug(f"OpenAI: Getting embedding for text (async)...")
+    response = await aembedding(input=[text], model=EMBEDDING_MODEL)
+    embedding = response["data"][0]["embedding"]
+    await asyncio.to_thread(embedding_cache.put, text, EMBEDDING_MODEL, embedding)
+    return embedding
 
 
 # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-def num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613"):
-    """Return the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
+@functools.lru_cache(maxsize=None)
+def get_token_encoding(model="gpt-3.5-turbo-0613"):
+    """
+    Return the encoding and per-message overheads for a model as
+    (encoding, tokens_per_message, tokens_per_name). Cached per model.
+    """
     if model in {
         "gpt-3.5-turbo-0613",
         "gpt-3.5-turbo-16k-0613",
@@ -136,22 +615,82 @@ def num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613"):
         tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
         tokens_per_name = -1  # if there's a name, the role is omitted
     elif "gpt-3.5-turbo-16k" in model:
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo-16k-0613")
+        return get_token_encoding("gpt-3.5-turbo-16k-0613")
     elif "gpt-3.5-turbo" in model:
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613")
+        return get_token_encoding("gpt-3.5-turbo-0613")
     elif "gpt-4" in model:
         print("Warning: gpt-4 may update over time. Returning num tokens assuming gpt-4-0613.")
-        return num_tokens_from_messages(messages, model="gpt-4-0613")
+        return get_token_encoding("gpt-4-0613")
     else:
         raise NotImplementedError(
             f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
         )
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        print("Warning: model not found. Using cl100k_base encoding.")
+        encoding = tiktoken.get_encoding("cl100k_base")
+    return encoding, tokens_per_message, tokens_per_name
+
+
+@functools.lru_cache(maxsize=16384)
+def num_tokens_from_text(text, model="gpt-3.5-turbo-0613"):
+    """Return the number of tokens in a string. Cached per (text, model)."""
+    encoding, _, _ = get_token_encoding(model)
+    return len(encoding.encode(text))
+
+
+def num_tokens_from_message(message, model="gpt-3.5-turbo-0613"):
+    """Return the number of tokens a single message adds to a request."""
+    _, tokens_per_message, tokens_per_name = get_token_encoding(model)
+    num_tokens = tokens_per_message
+    for key, value in message.items():
+        num_tokens += num_tokens_from_text(value, model)
+        if key == "name":
+            num_tokens += tokens_per_name
+    return num_tokens
+
+
+def num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613"):
+    """Return the number of tokens used by a list of messages."""
+    num_tokens = sum(num_tokens_from_message(message, model) for message in messages)
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-    return num_tokens
\ No newline at end of file
+    return num_tokens
+
+
+class TokenBudget:
+    """
+    Packs messages into a request without re-counting what has already been added.
+
+    Each message is counted once (and cached), so adding n messages costs O(n)
+    rather than re-encoding the whole list on every check.
+    """
+    def __init__(self, model, limit, messages=()):
+        self.model = model
+        self.limit = limit
+        self.used = 3  # every reply is primed with <|start|>assistant<|message|>
+        for message in messages:
+            self.used += num_tokens_from_message(message, model)
+
+    def cost(self, messages):
+        return sum(num_tokens_from_message(message, self.model) for message in messages)
+
+    def remaining(self):
+        return self.limit - self.used
+
+    def add(self, messages):
+        """
+        Reserves room for the messages if they all fit within the limit.
+        Returns whether they were added.
+        """
+        return self.reserve(self.cost(messages))
+
+    def reserve(self, num_tokens):
+        """
+        Reserves an already-counted number of tokens if they fit within the limit.
+        Returns whether they were reserved.
+        """
+        if self.used + num_tokens > self.limit:
+            return False
+        self.used += num_tokens
+        return True
@@ -0,0 +1,81 @@
+import re
+import asyncio
+import threading
+
+import numpy as np
+
+from config import get_logger
+from openai_tools import get_embedding, get_embeddings, aget_embedding
+
+logger = get_logger(__name__)
+
+# Directive phrases worth pinning (or unpinning). Single words like "always"
+# or "i'm" show up in most messages, so only whole phrases are matched.
+DEFAULT_PIN_PATTERN = (
+    r"\b(remember (that|this)|don'?t forget|forget (that|this|what|about|everything)|from now on|going forward"
+    r"|make sure (to|you)|call me|my name is|i prefer|(the|these|your|new) (rules|instructions)|unpin|no longer)\b"
+)
+
+# Examples of messages that should be pinned or unpinned
+PIN_EXEMPLARS = [
+    "Remember that my name is Sam.",
+    "From now on, always answer in Spanish.",
+    "Never use emojis in your replies.",
+    "Please keep your answers under three sentences.",
+    "Here are the rules you must follow in this channel.",
+    "Forget what I told you earlier, you don't need to do that anymore.",
+    "Call me captain from now on.",
+]
+
+_exemplar_lock = threading.Lock()
+_exemplar_matrix = None
+
+def exemplar_matrix():
+    """
+    Returns the normalized embeddings of `PIN_EXEMPLARS`, embedding them on first use.
+    """
+    global _exemplar_matrix
+    with _exemplar_lock:
+        if _exemplar_matrix is None:
+            matrix = np.asarray(get_embeddings(PIN_EXEMPLARS), dtype=np.float32)
+            _exemplar_matrix = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+        return _exemplar_matrix
+
+class PinFilter:
+    """
+    A local pre-filter deciding which messages are worth asking GPT to pin.
+
+    Modes:
+    "keywords": messages matching `pattern` (case insensitive) are candidates.
+    "embedding": messages whose embedding has a cosine similarity of at least
+        `threshold` to one of `PIN_EXEMPLARS` are candidates. The message's
+        embedding is the same one used to search long-term memory, so it is
+        usually already cached.
+    "none": every message is a candidate.
+    """
+    def __init__(self, mode="keywords", pattern=None, threshold=0.8):
+        self.mode = mode
+        self.pattern = re.compile(pattern or DEFAULT_PIN_PATTERN, re.IGNORECASE)
+        self.threshold = threshold
+
+    def similarity(self, embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        return float(np.max(exemplar_matrix() @ vector) / np.linalg.norm(vector))
+
+    def is_candidate(self, message, embedding=None):
+        if self.mode == "none":
+            return True
+        if self.mode == "embedding":
+            if embedding is None:
+                embedding = get_embedding(message)
+            return self.similarity(embedding) >= self.threshold
+        return bool(self.pattern.search(message))
+
+    async def ais_candidate(self, message, embedding=None):
+        if self.mode == "embedding":
+            if _exemplar_matrix is None:
+                await asyncio.to_thread(exemplar_matrix)
+            if embedding is None:
+                embedding = await aget_embedding(message)
+            return self.similarity(embedding) >= self.threshold
+        return self.is_candidate(message)
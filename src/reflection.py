@@ -0,0 +1,99 @@
+import threading
+from collections import OrderedDict
+
+from config import REFLECTION_WORKERS, REFLECTION_MAX_PENDING, REFLECTION_DROP_POLICY, get_logger
+from metrics import metrics
+
+logger = get_logger(__name__)
+
+class ReflectionScheduler:
+    """
+    Defers reflection until enough has happened to be worth reflecting on.
+
+    Turns are accumulated per (bot, partition). Once their total importance
+    reaches the memory's `reflection_importance` or their count reaches its
+    `reflection_turns`, the accumulated window is queued and reflected on by
+    one of `workers` background threads. Each window only covers turns since
+    the previous one, and a window queued for a key that already has one
+    waiting is merged into it, so the same turns are never reflected on twice.
+
+    At most `max_pending` windows wait at a time. When the queue is full,
+    `drop_policy` decides whether the oldest waiting window ("oldest") or the
+    new one ("newest") is dropped.
+    """
+    def __init__(self, workers=REFLECTION_WORKERS, max_pending=REFLECTION_MAX_PENDING, drop_policy=REFLECTION_DROP_POLICY, max_window=40):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.drop_policy = drop_policy
+        self.max_window = max_window
+        # (bot, partition) -> [messages, importance, turns] since the last reflection
+        self.accumulated = {}
+        # (bot, partition) -> (memory, messages) waiting for a worker
+        self.pending = OrderedDict()
+        self.dropped = 0
+        self.condition = threading.Condition()
+        self.threads = []
+
+    def observe(self, memory, messages, importance):
+        """
+        Records a turn and queues a reflection if the memory's thresholds are reached.
+
+        Parameters:
+        memory: The Memory to reflect into.
+        messages: The messages of the turn.
+        importance: The importance of the turn, from 0 to 1, or None if it
+            has not been rated yet (only the turn count applies).
+        """
+        key = (memory.name, memory.partition)
+        with self.condition:
+            window = self.accumulated.setdefault(key, [[], 0.0, 0])
+            window[0].extend(messages)
+            window[1] += importance or 0
+            window[2] += 1
+            if window[1] < memory.reflection_importance and window[2] < memory.reflection_turns:
+                return
+            del self.accumulated[key]
+            self.enqueue(key, memory, window[0])
+
+    def enqueue(self, key, memory, messages):
+        if key in self.pending:
+            _, waiting = self.pending[key]
+            messages = waiting + messages
+        elif len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            if self.drop_policy == "newest":
+                logger.warning(f"Reflection: Queue full, dropping reflection for {key}")
+                return
+            dropped_key, _ = self.pending.popitem(last=False)
+            logger.warning(f"Reflection: Queue full, dropping reflection for {dropped_key}")
+        self.pending[key] = (memory, messages[-self.max_window:])
+        if len(self.threads) < self.workers:
+            thread = threading.Thread(target=self.run, name="reflection", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                key, (memory, messages) = self.pending.popitem(last=False)
+            logger.debug(f"Reflection: Reflecting on {len(messages)} messages for {key}")
+            try:
+                memory.reflect(messages)
+            except Exception as e:
+                logger.error(f"Reflection: Failed for {key}: {e}")
+
+    def stats(self):
+        with self.condition:
+            return {"pending": len(self.pending), "dropped": self.dropped}
+
+
+reflection_scheduler = ReflectionScheduler()
+
+metrics.register_gauge(
+    "reflection_queue",
+    lambda: [({"stat": key}, value) for key, value in reflection_scheduler.stats().items()],
+    "Reflections waiting for a worker, and reflections dropped because the queue was full.",
+)
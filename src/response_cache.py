@@ -0,0 +1,96 @@
+import time
+import hashlib
+import threading
+
+import numpy as np
+
+from config import get_logger
+
+logger = get_logger(__name__)
+
+class ResponseCache:
+    """
+    Caches responses by the embedding of the message they answered.
+
+    A lookup returns the cached response whose message is the most similar to
+    the new one, if the cosine similarity is at least `threshold` and the entry
+    was stored under the same key (see `config_key`) less than `ttl` seconds
+    ago. Up to `max_entries` responses are kept, evicting the least recently
+    used once full. Vectors are kept normalized in one preallocated matrix, so
+    a lookup is a single matrix-vector product.
+    """
+    def __init__(self, max_entries=1000, ttl=3600, threshold=0.95, dimensions=1536):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.vectors = np.zeros((max_entries, dimensions), dtype=np.float32)
+        self.keys = np.full(max_entries, None, dtype=object)
+        self.responses = [None] * max_entries
+        self.stored_at = np.full(max_entries, -np.inf)
+        self.used_at = np.full(max_entries, -np.inf)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def config_key(system_prompt, model, temperature, *context):
+        """
+        Responses are only reused between requests made with the same system
+        prompt, model and temperature, and the same extra `context` strings
+        (such as the channel's pinned message and summary).
+        """
+        parts = [model, str(float(temperature)), system_prompt, *(str(part) for part in context)]
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def get(self, key, embedding):
+        """
+        Returns the cached response for a similar message, or None.
+        """
+        vector = self.normalize(embedding)
+        now = time.monotonic()
+        with self.lock:
+            similarities = self.vectors @ vector
+            valid = (self.keys == key) & (now - self.stored_at < self.ttl)
+            similarities[~valid] = -np.inf
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            self.used_at[best] = now
+            self.hits += 1
+            logger.debug(f"ResponseCache: Hit with similarity {similarities[best]:.3f}")
+            return self.responses[best]
+
+    def put(self, key, embedding, response):
+        now = time.monotonic()
+        with self.lock:
+            # reuse an empty or expired slot, otherwise the least recently used
+            expired = np.flatnonzero(now - self.stored_at >= self.ttl)
+            if expired.size:
+                slot = int(expired[0])
+            else:
+                slot = int(np.argmin(self.used_at))
+                self.evictions += 1
+            self.vectors[slot] = self.normalize(embedding)
+            self.keys[slot] = key
+            self.responses[slot] = response
+            self.stored_at[slot] = now
+            self.used_at[slot] = now
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": int(np.count_nonzero(self.keys != None)),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
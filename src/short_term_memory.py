@@ -0,0 +1,282 @@
+import os
+import json
+import time
+import atexit
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+
+from config import SHORT_TERM_STORE, SHORT_TERM_STORE_PATH, SHORT_TERM_FLUSH_INTERVAL, get_logger
+from openai_tools import num_tokens_from_message
+
+logger = get_logger(__name__)
+
+# the most messages kept waiting to be summarized; older ones are dropped
+MAX_UNSUMMARIZED_MESSAGES = 200
+
+class ShortTermMemory:
+    """
+    A channel's recent conversation, pinned message and running summary.
+
+    Messages are kept in a ring buffer alongside their token counts, so trimming
+    and prompt packing never re-encode the history. Trimmed messages can be
+    queued to be folded into the summary.
+    """
+    def __init__(self, model, messages=(), pinned_message=None, summary=None, unsummarized=()):
+        self.model = model
+        self.messages = deque()
+        self.token_counts = deque()
+        self.num_tokens = 0
+        self.pinned_message = pinned_message
+        self.summary = summary
+        self.unsummarized = list(unsummarized)
+        self.summarizing = False
+        # pin decisions are applied in the order they were requested
+        self.pin_tickets = 0
+        self.pinned_ticket = 0
+        self.lock = threading.RLock()
+        self.extend(messages)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(list(self.messages))
+
+    def __repr__(self):
+        return repr(list(self.messages))
+
+    def set_model(self, model):
+        """
+        Recounts tokens if the bot's model (and so its encoding) changed.
+        """
+        with self.lock:
+            if model == self.model:
+                return
+            self.model = model
+            self.token_counts = deque(num_tokens_from_message(msg, model) for msg in self.messages)
+            self.num_tokens = sum(self.token_counts)
+
+    def extend(self, messages):
+        with self.lock:
+            for message in messages:
+                num_tokens = num_tokens_from_message(message, self.model)
+                self.messages.append(message)
+                self.token_counts.append(num_tokens)
+                self.num_tokens += num_tokens
+
+    def items(self):
+        """
+        Returns (message, token count) pairs, oldest first.
+        """
+        with self.lock:
+            return list(zip(self.messages, self.token_counts))
+
+    def trim(self, max_tokens=None, max_messages=None):
+        """
+        Drops the oldest messages until both limits are met. Token limits include
+        the 3 tokens priming the reply, as in `num_tokens_from_messages`.
+
+        Returns the dropped messages.
+        """
+        evicted = []
+        with self.lock:
+            while self.messages and (
+                (max_tokens is not None and self.num_tokens + 3 > max_tokens)
+                or (max_messages is not None and len(self.messages) > max_messages)
+            ):
+                evicted.append(self.messages.popleft())
+                self.num_tokens -= self.token_counts.popleft()
+        return evicted
+
+    def pin_ticket(self):
+        """
+        Returns a ticket ordering a pin decision that is about to be made.
+        """
+        with self.lock:
+            self.pin_tickets += 1
+            return self.pin_tickets
+
+    def pin(self, message, ticket=None):
+        """
+        Sets the pinned message unless a decision requested after `ticket` was
+        already applied. Returns whether the message was set.
+        """
+        with self.lock:
+            if ticket is None:
+                ticket = self.pin_ticket()
+            if ticket < self.pinned_ticket:
+                return False
+            self.pinned_ticket = ticket
+            self.pinned_message = message
+            return True
+
+    def queue_summary(self, messages):
+        """
+        Queues evicted messages to be summarized. Returns True if the caller
+        should start summarizing, False if a summarizer is already running.
+        """
+        with self.lock:
+            self.unsummarized.extend(messages)
+            del self.unsummarized[:-MAX_UNSUMMARIZED_MESSAGES]
+            if self.summarizing or not self.unsummarized:
+                return False
+            self.summarizing = True
+            return True
+
+    def take_unsummarized(self):
+        """
+        Returns and clears the queued messages. Once the queue is empty the
+        running summarizer is done.
+        """
+        with self.lock:
+            messages, self.unsummarized = self.unsummarized, []
+            if not messages:
+                self.summarizing = False
+            return messages
+
+    def requeue_summary(self, messages):
+        """
+        Puts back messages taken by a summary that failed, ahead of any queued
+        since, and stops the running summarizer. The next `queue_summary`
+        starts a new one, which retries them.
+        """
+        with self.lock:
+            self.unsummarized[:0] = messages
+            del self.unsummarized[:-MAX_UNSUMMARIZED_MESSAGES]
+            self.summarizing = False
+
+    def clear(self):
+        with self.lock:
+            self.messages.clear()
+            self.token_counts.clear()
+            self.num_tokens = 0
+            self.summary = None
+            self.unsummarized = []
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "messages": list(self.messages),
+                "pinned_message": self.pinned_message,
+                "summary": self.summary,
+                "unsummarized": list(self.unsummarized),
+            }
+
+class ShortTermStore(ABC):
+    """
+    Persists short-term memory per (bot, channel) with a write-behind buffer:
+    changed memories are marked dirty and written by a background thread every
+    `flush_interval` seconds, and once more at exit.
+
+    Subclasses implement `read` and `write`.
+    """
+    def __init__(self, flush_interval=SHORT_TERM_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.dirty = {}
+        self.lock = threading.Lock()
+        threading.Thread(target=self.run, name="short-term-store", daemon=True).start()
+        atexit.register(self.flush)
+
+    @staticmethod
+    def channel_key(channel_id):
+        return "" if channel_id is None else str(channel_id)
+
+    def load(self, bot_name, channel_id):
+        """
+        Returns the stored `ShortTermMemory.to_dict` dict, or None.
+        """
+        try:
+            return self.read(bot_name, self.channel_key(channel_id))
+        except Exception as e:
+            logger.error(f"ShortTermStore: Could not load {bot_name}/{channel_id}: {e}")
+            return None
+
+    def mark_dirty(self, bot_name, channel_id, memory):
+        with self.lock:
+            self.dirty[(bot_name, self.channel_key(channel_id))] = memory
+
+    def flush(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+        if not dirty:
+            return
+        try:
+            self.write([(bot_name, channel, memory.to_dict()) for (bot_name, channel), memory in dirty.items()])
+        except Exception as e:
+            logger.error(f"ShortTermStore: Could not write {len(dirty)} short-term memories: {e}")
+            with self.lock:
+                # keep newer changes made since the flush started
+                self.dirty = {**dirty, **self.dirty}
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    @abstractmethod
+    def read(self, bot_name, channel):
+        """
+        Returns the stored dict for the bot's channel key, or None.
+        """
+
+    @abstractmethod
+    def write(self, records):
+        """
+        Stores a list of (bot_name, channel, data) records.
+        """
+
+class FileShortTermStore(ShortTermStore):
+    """
+    Stores each channel's short-term memory as a JSON file under `path/<bot>/`.
+    """
+    def __init__(self, path=SHORT_TERM_STORE_PATH, **kwargs):
+        self.path = path
+        super().__init__(**kwargs)
+
+    def file_path(self, bot_name, channel):
+        return os.path.join(self.path, bot_name, f"{channel or 'default'}.json")
+
+    def read(self, bot_name, channel):
+        file_path = self.file_path(bot_name, channel)
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, "r") as f:
+            return json.load(f)
+
+    def write(self, records):
+        for bot_name, channel, data in records:
+            file_path = self.file_path(bot_name, channel)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path + ".tmp", "w") as f:
+                json.dump(data, f)
+            os.replace(file_path + ".tmp", file_path)
+
+class DBShortTermStore(ShortTermStore):
+    """
+    Stores short-term memory in the `short_term_memory` table of the config database.
+    """
+    def __init__(self, db, **kwargs):
+        self.db = db
+        self.db.setup_short_term_memory_table()
+        super().__init__(**kwargs)
+
+    def read(self, bot_name, channel):
+        return self.db.load_short_term_memory(bot_name, channel)
+
+    def write(self, records):
+        self.db.save_short_term_memories(records)
+
+def create_short_term_store(db):
+    """
+    Returns the store selected by SHORT_TERM_STORE: "db", "file", "none", or
+    "auto" (the database when one is configured, otherwise files).
+    """
+    kind = SHORT_TERM_STORE
+    if kind == "auto":
+        kind = "file" if db.disabled else "db"
+    if kind == "db":
+        return DBShortTermStore(db)
+    if kind == "file":
+        return FileShortTermStore()
+    return None